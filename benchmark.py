@@ -0,0 +1,344 @@
+"""
+Benchmarks of the codec and connection hot paths. Everything runs in memory,
+except for the end-to-end benchmark which runs a client and the sample server
+on the loopback interface.
+
+Every benchmark reports operations per second (the best of a few timed runs)
+and the objects retained per operation: the growth of the objects tracked by
+the garbage collector over a run with the collector disabled. Python 2 has no
+way to count allocations, so this only catches objects that an operation
+leaves alive or in reference cycles (leaks, growing caches or queues, garbage
+for the collector), not temporary ones.
+
+Usage:
+    python benchmark.py [-k NAME] [--save FILE] [--compare FILE]
+
+--save stores the results as a JSON baseline, --compare reports the changes
+against a baseline and exits with status 1 if any benchmark regressed by more
+than the threshold (in speed, or in retained objects).
+"""
+
+import argparse
+import gc
+import io
+import json
+import platform
+import sys
+import threading
+import time
+
+import rtmp_amf0
+import rtmp_protocol
+import rtmp_protocol_base
+import sample_rtmp_server
+
+BENCHMARKS = []
+
+def benchmark(name):
+    """
+    Register a benchmark. The decorated function prepares the data and
+    returns the operation to time: a callable that returns the number of
+    operations it performed (None for one).
+    """
+    def register(function):
+        BENCHMARKS.append((name, function))
+        return function
+    return register
+
+CONNECT_RESULT = [
+    u'_result',
+    1,
+    {'capabilities': 31, 'fmsVer': u'FMS/3,0,2,217'},
+    {
+        'code': u'NetConnection.Connect.Success',
+        'objectEncoding': 0,
+        'description': u'Connection succeeded.',
+        'level': u'status'
+    }
+]
+
+def shared_object_message(keys, value_size):
+    """ Return a shared object message that changes a number of keys. """
+    changes = {}
+    for i in xrange(keys):
+        changes[u'key%d' % i] = u'x' * value_size
+    return rtmp_protocol.SharedObjectMessage(u'so_name', 1, events=[
+        rtmp_protocol.SOEvent(rtmp_protocol.SOEventTypes.CHANGE, changes),
+    ])
+
+def new_writer(chunk_size=128):
+    """ Return a writer into memory. """
+    writer = rtmp_protocol.RtmpWriter(
+        rtmp_protocol.FileDataTypeMixIn(io.BytesIO()))
+    writer.chunk_size = chunk_size
+    return writer
+
+@benchmark('header_encode')
+def bench_header_encode():
+    header = rtmp_protocol_base.Header(3, 40, 20, 300, 0)
+    previous = rtmp_protocol_base.Header(3, 0, 20, 280, 0)
+    stream = io.BytesIO()
+
+    def op():
+        stream.seek(0)
+        rtmp_protocol_base.header_encode(stream, header, previous)
+    return op
+
+@benchmark('header_decode')
+def bench_header_decode():
+    stream = io.BytesIO()
+    rtmp_protocol_base.header_encode(stream,
+        rtmp_protocol_base.Header(3, 1000, 20, 300, 0))
+
+    def op():
+        stream.seek(0)
+        rtmp_protocol_base.header_decode(stream)
+    return op
+
+def bench_reader(body_size, chunk_size, count=100):
+    writer = new_writer(chunk_size)
+    for i in xrange(count):
+        writer.write(rtmp_protocol.DataMessage([u'x' * body_size],
+            timestamp=i * 40))
+    data = writer.stream.fileobject.getvalue()
+
+    def op():
+        reader = rtmp_protocol.RtmpReader(
+            rtmp_protocol.FileDataTypeMixIn(io.BytesIO(data)))
+        reader.chunk_size = chunk_size
+        for i in xrange(count):
+            reader.next()
+        return count
+    return op
+
+for body_size in (100, 1000, 10000):
+    for chunk_size in (128, 4096):
+        benchmark('reader_next_%d_chunk_%d' % (body_size, chunk_size))(
+            lambda body_size=body_size, chunk_size=chunk_size:
+                bench_reader(body_size, chunk_size))
+
+@benchmark('writer_write_command')
+def bench_writer_command():
+    writer = new_writer()
+    fileobject = writer.stream.fileobject
+
+    def op():
+        fileobject.seek(0)
+        fileobject.truncate()
+        writer.write(rtmp_protocol.CommandMessage(CONNECT_RESULT))
+    return op
+
+@benchmark('writer_write_shared_object')
+def bench_writer_shared_object():
+    writer = new_writer()
+    fileobject = writer.stream.fileobject
+    message = shared_object_message(10, 20)
+    events = message.events
+
+    def op():
+        fileobject.seek(0)
+        fileobject.truncate()
+        writer.write(rtmp_protocol.SharedObjectMessage(u'so_name', 1,
+            events=events))
+    return op
+
+@benchmark('read_shared_object_event')
+def bench_read_shared_object_event():
+    body = rtmp_protocol.encode_message_body(shared_object_message(10, 20))
+    start = len(rtmp_amf0.encode_string(u'so_name')) + 12
+
+    def op():
+        decoder = rtmp_amf0.Decoder(body, start)
+        rtmp_protocol.read_shared_object_event(decoder, decoder)
+    return op
+
+class CountingSharedObject(rtmp_protocol.FlashSharedObject):
+    """ A shared object that counts the received changes. """
+
+    def __init__(self, name):
+        rtmp_protocol.FlashSharedObject.__init__(self, name)
+        self.changes = 0
+        self.condition = threading.Condition()
+
+    def on_changes(self, keys):
+        with self.condition:
+            self.changes += 1
+            self.condition.notify()
+
+@benchmark('end_to_end_shared_object')
+def bench_end_to_end(count=200):
+    """
+    One client changes a shared object, the sample server sends the changes
+    to another client. Operations are messages received by the other client.
+    """
+    server = sample_rtmp_server.RTMPServer(('127.0.0.1', 0))
+    port = server.socket.getsockname()[1]
+    server_thread = threading.Thread(target=server.serve_forever,
+        args=(0.05,))
+    server_thread.daemon = True
+    server_thread.start()
+
+    sender = rtmp_protocol.RtmpClient('127.0.0.1', port, '', '', '', '')
+    sender.connect([])
+    sender_so = rtmp_protocol.FlashSharedObject(u'bench')
+    sender.shared_object_use(sender_so)
+    receiver = rtmp_protocol.RtmpClient('127.0.0.1', port, '', '', '', '')
+    receiver.connect([])
+    receiver_so = CountingSharedObject(u'bench')
+    receiver.shared_object_use(receiver_so)
+    for client in (sender, receiver):
+        client_thread = threading.Thread(target=client.handle_messages)
+        client_thread.daemon = True
+        client_thread.start()
+    # The changes are only sent to the receiver once it has subscribed.
+    deadline = time.time() + 5
+    while not receiver_so.use_success:
+        if time.time() > deadline:
+            raise RuntimeError('The shared object was not acquired')
+        time.sleep(0.01)
+    state = {'value': 0}
+
+    def op():
+        with receiver_so.condition:
+            expected = receiver_so.changes + count
+        for i in xrange(count):
+            state['value'] += 1
+            sender_so.set(u'value', state['value'])
+            sender_so.flush()
+        with receiver_so.condition:
+            deadline = time.time() + 5
+            while receiver_so.changes < expected:
+                if time.time() > deadline:
+                    raise RuntimeError('%d changes were not received' %
+                        (expected - receiver_so.changes))
+                receiver_so.condition.wait(1.0)
+        return count
+    return op
+
+def measure(op, min_time, repeat=3):
+    """
+    Return the best operations per second of repeat runs that take at least
+    min_time seconds each.
+    """
+    loops = 1
+    while True:
+        start = time.time()
+        ops = run(op, loops)
+        elapsed = time.time() - start
+        if elapsed >= min_time / 10:
+            break
+        loops *= 10
+    loops = max(1, int(loops * min_time / max(elapsed, 1e-9)))
+
+    best = 0
+    for i in xrange(repeat):
+        start = time.time()
+        ops = run(op, loops)
+        best = max(best, ops / max(time.time() - start, 1e-9))
+    return best
+
+def run(op, loops):
+    """ Call op loops times and return the number of operations. """
+    ops = 0
+    for i in xrange(loops):
+        ops += op() or 1
+    return ops
+
+def retained_objects(op, loops=100):
+    """
+    Return the objects tracked by the garbage collector that are left alive
+    per operation. The collector is disabled during the run, so that it
+    does not free the cycles created by the operation.
+    """
+    run(op, 1)
+    gc.collect()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        ops = run(op, loops)
+        after = len(gc.get_objects())
+    finally:
+        if enabled:
+            gc.enable()
+    return float(after - before) / ops
+
+def run_benchmarks(pattern=None, min_time=0.2):
+    """ Run the benchmarks whose name contains pattern. """
+    results = {}
+    for name, function in BENCHMARKS:
+        if pattern and pattern not in name:
+            continue
+        op = function()
+        results[name] = {
+            'ops_per_sec': measure(op, min_time),
+            'retained_objects': retained_objects(op,
+                10 if 'end_to_end' in name else 100),
+        }
+        print '%-36s %14.1f ops/sec %10.2f objs/op' % (name,
+            results[name]['ops_per_sec'], results[name]['retained_objects'])
+        sys.stdout.flush()
+    return results
+
+def compare(results, baseline, threshold):
+    """
+    Print the changes against a baseline and return the names of the
+    benchmarks that regressed by more than threshold (a fraction), or that
+    retain more objects per operation (by at least one).
+    """
+    regressions = []
+    print
+    print '%-36s %10s %10s' % ('change against baseline', 'ops/sec',
+        'objs/op')
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        new = results[name]
+        speed = new['ops_per_sec'] / old['ops_per_sec'] - 1
+        regressed = speed < -threshold
+        if old.get('retained_objects') is None:
+            objects = '%10s' % '-'
+        else:
+            diff = new['retained_objects'] - old['retained_objects']
+            objects = '%+10.2f' % diff
+            regressed = regressed or \
+                diff > max(1.0, old['retained_objects'] * threshold)
+        if regressed:
+            regressions.append(name)
+        print '%-36s %+9.1f%% %s%s' % (name, speed * 100, objects,
+            '  REGRESSION' if regressed else '')
+    return regressions
+
+def main():
+    """ Run the benchmarks from the command line. """
+    parser = argparse.ArgumentParser(description='Run the RTMP benchmarks.')
+    parser.add_argument('-k', dest='pattern',
+        help='only run the benchmarks whose name contains PATTERN')
+    parser.add_argument('--min-time', type=float, default=0.2,
+        help='minimum duration of a timed run in seconds')
+    parser.add_argument('--save', metavar='FILE',
+        help='save the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE',
+        help='compare the results with a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help='regression threshold as a fraction (default 0.1)')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.pattern, args.min_time)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'benchmarks': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['benchmarks']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,445 @@
+"""
+Load generator that simulates many RtmpClient sessions against a local
+server, to find the number of sessions that the server can handle.
+
+Every session performs the handshake, connects, uses a shared object (the
+sessions are split into groups that share one) and then keeps changing its
+own property of the shared object and pinging the server. The property values
+are the times at which they were changed, so the other sessions of the group
+measure the end-to-end latency of the changes.
+
+The number of sessions is ramped up in steps. After each step, the load
+generator reports the connection setup rate, the messages sent and received
+per second, the latency percentiles and the resident memory of the server.
+
+Usage:
+    python loadgen.py [--sessions N] [--step N] [--duration SECONDS]
+
+By default the sample server is started in a child process on a free
+loopback port (pre-forked if --workers is given). --server HOST:PORT targets a
+running server instead (with --server-pid for its memory usage).
+"""
+
+import argparse
+import json
+import os
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+import rtmp_protocol
+import sample_rtmp_server
+
+class Stats:
+    """ Counters and latencies shared by all the sessions. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Start a new measurement period. """
+        with self.lock:
+            self.start = time.time()
+            self.sent = 0
+            self.received = 0
+            self.latencies = []
+            self.ping_times = []
+            self.errors = 0
+
+    def add_sent(self, count=1):
+        with self.lock:
+            self.sent += count
+
+    def add_latency(self, latency):
+        with self.lock:
+            self.received += 1
+            self.latencies.append(latency)
+
+    def add_ping_time(self, ping_time):
+        with self.lock:
+            self.received += 1
+            self.ping_times.append(ping_time)
+
+    def add_error(self):
+        with self.lock:
+            self.errors += 1
+
+def percentile(values, fraction):
+    """ Return the percentile of sorted values, None if there are none. """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class LoadSharedObject(rtmp_protocol.FlashSharedObject):
+    """
+    The shared object of a group of sessions. Every session sets its own
+    property to the current time, the latency of the changes made by the
+    other sessions is recorded when they are received.
+    """
+
+    def __init__(self, name, key, stats):
+        rtmp_protocol.FlashSharedObject.__init__(self, name)
+        self.key = key
+        self.stats = stats
+
+    def on_changes(self, keys):
+        now = time.time()
+        for key in keys:
+            if key != self.key:
+                self.stats.add_latency(now - self.data[key])
+
+class LoadClient(rtmp_protocol.RtmpClient):
+    """
+    An RtmpClient whose messages are handled by a reader thread while another
+    thread sends changes and pings. Ping responses are timed.
+    """
+
+    def __init__(self, host, port, stats):
+        rtmp_protocol.RtmpClient.__init__(self, host, port, '', '', '', '')
+        self.stats = stats
+        self.next_ping = 0
+        self.pings = {}
+
+    def handle_user_control(self, msg):
+        if msg.event_type != rtmp_protocol.UserControlTypes.PING_RESPONSE:
+            return rtmp_protocol.RtmpClient.handle_user_control(self, msg)
+        sent = self.pings.pop(struct.unpack('!L', msg.event_data[:4])[0],
+            None)
+        if sent is not None:
+            self.stats.add_ping_time(time.time() - sent)
+        return True
+
+    def ping(self):
+        """ Send a ping request with a sequence number. """
+        with self.lock:
+            self.pings[self.next_ping] = time.time()
+            self.writer.write(rtmp_protocol.UserControlMessage(
+                rtmp_protocol.UserControlTypes.PING_REQUEST,
+                struct.pack('!L', self.next_ping)))
+            self.writer.flush()
+            self.next_ping = (self.next_ping + 1) & 0xffffffff
+
+class Session:
+    """ A simulated client: an RtmpClient with its reader thread. """
+
+    def __init__(self, index, address, group_size, stats):
+        self.index = index
+        self.stats = stats
+        self.client = LoadClient(address[0], address[1], stats)
+        self.so = LoadSharedObject(u'load%d' % (index // group_size),
+            u's%d' % index, stats)
+        self.closed = False
+
+    def start(self, timeout=30):
+        """
+        Connect, use the shared object and wait until the server sent its
+        contents. Return the setup time.
+        """
+        start = time.time()
+        self.client.connect([])
+        self.client.shared_object_use(self.so)
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        while not self.so.use_success:
+            if self.closed or time.time() - start > timeout:
+                raise IOError('The shared object was not acquired')
+            time.sleep(0.001)
+        return time.time() - start
+
+    def run(self):
+        """ Handle the messages of the server until the session is closed. """
+        try:
+            self.client.handle_messages()
+        except Exception:
+            if not self.closed:
+                self.stats.add_error()
+                self.closed = True
+
+    def update(self):
+        """ Change the property of the session to the current time. """
+        self.so.set(self.so.key, time.time())
+        self.so.flush()
+        self.stats.add_sent()
+
+    def ping(self):
+        self.client.ping()
+        self.stats.add_sent()
+
+    def close(self):
+        self.closed = True
+        try:
+            self.client.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.client.socket.close()
+
+def open_sessions(sessions, address, count, group_size, stats,
+                  concurrency):
+    """
+    Open sessions until there are count of them, with concurrency threads.
+    Return the setup times of the new sessions.
+    """
+    setup_times = []
+    lock = threading.Lock()
+    indexes = iter(xrange(len(sessions), count))
+
+    def connect():
+        while True:
+            with lock:
+                index = next(indexes, None)
+            if index is None:
+                return
+            session = Session(index, address, group_size, stats)
+            try:
+                setup_time = session.start()
+            except Exception:
+                stats.add_error()
+                session.close()
+                continue
+            with lock:
+                sessions.append(session)
+                setup_times.append(setup_time)
+
+    threads = [threading.Thread(target=connect) for i in xrange(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return setup_times
+
+def drive(sessions, duration, rate, ping_every):
+    """
+    Make every session send rate changes per second for duration seconds, and
+    a ping instead of every ping_every-th change.
+    """
+    deadline = time.time() + duration
+    interval = 1.0 / rate
+    rounds = 0
+    while time.time() < deadline:
+        round_start = time.time()
+        for session in list(sessions):
+            if session.closed:
+                continue
+            try:
+                if ping_every and rounds % ping_every == ping_every - 1:
+                    session.ping()
+                else:
+                    session.update()
+            except Exception:
+                session.stats.add_error()
+                session.close()
+        rounds += 1
+        time.sleep(max(0, interval - (time.time() - round_start)))
+
+def process_rss(pid):
+    """ Return the resident memory of a process in bytes (Linux only). """
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        return None
+    return None
+
+def child_pids(pid):
+    """ Return the ids of the child processes of a process (Linux only). """
+    children = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                # The parent id follows the command name, in parentheses.
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(name))
+    return children
+
+def server_rss(pid):
+    """
+    Return the resident memory of a server process and of its worker
+    processes in bytes (Linux only).
+    """
+    if pid is None:
+        return None
+    total = process_rss(pid)
+    if total is None:
+        return None
+    for child in child_pids(pid):
+        total += process_rss(child) or 0
+    return total
+
+def start_server(workers):
+    """
+    Start the sample server in a child process on a free loopback port, with
+    worker processes if workers is more than 1. Return the process and the
+    address of the server.
+    """
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+        '--serve', '--workers', str(workers)], stdout=subprocess.PIPE)
+    address = ('127.0.0.1', int(process.stdout.readline()))
+    # Wait until the server (or its workers) listens.
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(address).close()
+            break
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+    return process, address
+
+def serve(workers):
+    """
+    Run the sample server for the load generator. The port is written to the
+    standard output.
+    """
+    raise_file_limit()
+    if workers > 1:
+        # The workers bind the port themselves, find a free one.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        print port
+        sys.stdout.flush()
+        sample_rtmp_server.serve_prefork(('127.0.0.1', port), workers)
+        return
+
+    server = sample_rtmp_server.RTMPServer(('127.0.0.1', 0))
+    print server.socket.getsockname()[1]
+    sys.stdout.flush()
+    server.serve_forever()
+
+def raise_file_limit():
+    """ Allow as many open files as the hard limit. """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def format_value(value, scale=1, unit=''):
+    if value is None:
+        return '-'
+    return '%.1f%s' % (value * scale, unit)
+
+def main():
+    """ Run the load generator from the command line. """
+    parser = argparse.ArgumentParser(
+        description='Ramp up RTMP sessions against a local server.')
+    parser.add_argument('--sessions', type=int, default=1000,
+        help='number of sessions to ramp up to (default 1000)')
+    parser.add_argument('--step', type=int, default=100,
+        help='sessions added by every step (default 100)')
+    parser.add_argument('--duration', type=float, default=10,
+        help='seconds of traffic after every step (default 10)')
+    parser.add_argument('--rate', type=float, default=1,
+        help='messages sent per second by every session (default 1)')
+    parser.add_argument('--ping-every', type=int, default=5,
+        help='send a ping instead of every Nth change (0 disables pings)')
+    parser.add_argument('--group-size', type=int, default=10,
+        help='sessions that share a shared object (default 10)')
+    parser.add_argument('--concurrency', type=int, default=20,
+        help='sessions that connect at the same time (default 20)')
+    parser.add_argument('--workers', type=int, default=1,
+        help='worker processes of the sample server (default 1)')
+    parser.add_argument('--server', metavar='HOST:PORT',
+        help='use a running server instead of starting the sample server')
+    parser.add_argument('--server-pid', type=int,
+        help='process id of the running server, to report its memory')
+    parser.add_argument('--json', metavar='FILE',
+        help='write the results of every step to a JSON file')
+    parser.add_argument('--serve', action='store_true',
+        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.workers)
+        return
+
+    raise_file_limit()
+    # Every session has a thread that mostly waits for data.
+    threading.stack_size(256 * 1024)
+
+    process = None
+    if args.server:
+        host, port = args.server.rsplit(':', 1)
+        address = (host, int(port))
+        pid = args.server_pid
+    else:
+        process, address = start_server(args.workers)
+        pid = process.pid
+
+    stats = Stats()
+    sessions = []
+    results = []
+    print '%8s %10s %10s %10s %9s %9s %9s %9s %9s %7s' % ('sessions',
+        'setup/s', 'sent/s', 'recv/s', 'p50 ms', 'p99 ms', 'p999 ms',
+        'ping ms', 'rss MB', 'errors')
+    try:
+        count = 0
+        while count < args.sessions:
+            count = min(args.sessions, count + args.step)
+            stats.reset()
+            start = time.time()
+            setup_times = open_sessions(sessions, address, count,
+                args.group_size, stats, args.concurrency)
+            setup_rate = len(setup_times) / (time.time() - start)
+            setup_errors = stats.errors
+
+            stats.reset()
+            drive(sessions, args.duration, args.rate, args.ping_every)
+            # Let the last messages arrive.
+            time.sleep(min(1.0, args.duration))
+            elapsed = time.time() - stats.start
+            with stats.lock:
+                latencies = sorted(stats.latencies)
+                ping_times = sorted(stats.ping_times)
+                result = {
+                    'sessions': len([s for s in sessions if not s.closed]),
+                    'setup_per_sec': setup_rate,
+                    'setup_p99': percentile(sorted(setup_times), 0.99),
+                    'sent_per_sec': stats.sent / elapsed,
+                    'received_per_sec': stats.received / elapsed,
+                    'latency_p50': percentile(latencies, 0.5),
+                    'latency_p99': percentile(latencies, 0.99),
+                    'latency_p999': percentile(latencies, 0.999),
+                    'ping_p50': percentile(ping_times, 0.5),
+                    'server_rss': server_rss(pid),
+                    'errors': setup_errors + stats.errors,
+                }
+            results.append(result)
+            print '%8d %10.1f %10.1f %10.1f %9s %9s %9s %9s %9s %7d' % (
+                result['sessions'], result['setup_per_sec'],
+                result['sent_per_sec'], result['received_per_sec'],
+                format_value(result['latency_p50'], 1000),
+                format_value(result['latency_p99'], 1000),
+                format_value(result['latency_p999'], 1000),
+                format_value(result['ping_p50'], 1000),
+                format_value(result['server_rss'], 1.0 / 2 ** 20),
+                result['errors'])
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for session in sessions:
+            session.close()
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
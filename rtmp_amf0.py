@@ -0,0 +1,389 @@
+"""
+A small AMF0 encoder and decoder for the value types found in RTMP command,
+data and shared object messages: number, boolean, string, object, ECMA array,
+null, undefined and strict array (with references). The output is the same as
+the output of pyamf, which is not required by this module. Values of other
+types raise UnsupportedType, so that the caller can fall back to pyamf.
+"""
+
+import struct
+
+try:
+    import pyamf
+except ImportError:
+    pyamf = None
+
+NUMBER = '\x00'
+BOOL = '\x01'
+STRING = '\x02'
+OBJECT = '\x03'
+NULL = '\x05'
+UNDEFINED = '\x06'
+REFERENCE = '\x07'
+MIXED_ARRAY = '\x08'
+OBJECT_TERM = '\x09'
+ARRAY = '\x0a'
+LONG_STRING = '\x0c'
+UNSUPPORTED = '\x0d'
+
+if pyamf is not None:
+    # Decode to the same types as pyamf.
+    ASObject = pyamf.ASObject
+    MixedArray = pyamf.MixedArray
+    Undefined = pyamf.Undefined
+    UndefinedType = pyamf.UndefinedType
+else:
+    class ASObject(dict):
+        """ An anonymous AMF0 object. """
+
+    class MixedArray(dict):
+        """ An AMF0 ECMA array. """
+
+    class UndefinedType(object):
+        """ The type of the AMF0 undefined value. """
+
+        def __repr__(self):
+            return 'pyamf.Undefined'
+
+    Undefined = UndefinedType()
+
+_DOUBLE = struct.Struct('!d')
+_USHORT = struct.Struct('!H')
+_ULONG = struct.Struct('!L')
+
+# Repeated strings (property names, command names, status codes...) are
+# encoded and decoded once. The caches are cleared when they grow too big.
+MAX_CACHED_STRINGS = 4096
+MAX_CACHED_STRING_LENGTH = 64
+_encoded_strings = {}
+_decoded_strings = {}
+
+class UnsupportedType(Exception):
+    """
+    Raised for values (or AMF0 type markers) that this module does not
+    handle.
+    """
+
+def encode_string(s):
+    """
+    Return a string (unicode strings are UTF-8 encoded) prefixed with its
+    length, without a type marker.
+    """
+    encoded = _encoded_strings.get(s)
+    if encoded is not None:
+        return encoded
+    if type(s) is unicode:
+        data = s.encode('utf-8')
+    else:
+        data = s
+    if len(data) > 0xffff:
+        return _ULONG.pack(len(data)) + data
+    encoded = _USHORT.pack(len(data)) + data
+    if len(data) <= MAX_CACHED_STRING_LENGTH:
+        if len(_encoded_strings) >= MAX_CACHED_STRINGS:
+            _encoded_strings.clear()
+        _encoded_strings[s] = encoded
+    return encoded
+
+def _decode_string(data):
+    """ Return the unicode string of UTF-8 encoded bytes. """
+    s = _decoded_strings.get(data)
+    if s is not None:
+        return s
+    s = data.decode('utf-8')
+    if len(data) <= MAX_CACHED_STRING_LENGTH:
+        if len(_decoded_strings) >= MAX_CACHED_STRINGS:
+            _decoded_strings.clear()
+        _decoded_strings[data] = s
+    return s
+
+class Encoder(object):
+    """
+    Encodes AMF0 values. The values written by an encoder share a reference
+    table, like the values written by a pyamf encoder.
+    """
+
+    def __init__(self):
+        self.pieces = []
+        self.references = {}
+
+    def getvalue(self):
+        """ Return the encoded bytes. """
+        return ''.join(self.pieces)
+
+    def write_string(self, s):
+        """ Write a string without a type marker. """
+        self.pieces.append(encode_string(s))
+
+    def write_element(self, value):
+        """ Write a value with its type marker. """
+        writer = self._writers.get(type(value))
+        if writer is None:
+            writer = self._get_writer(value)
+        writer(self, value)
+
+    def _get_writer(self, value):
+        if isinstance(value, basestring):
+            return Encoder._write_string
+        raise UnsupportedType(type(value))
+
+    def _write_reference(self, value):
+        """
+        Write a reference if the object has already been written, otherwise
+        add it to the reference table. Return whether a reference was written.
+        """
+        index = self.references.get(id(value))
+        if index is not None and index <= 0xffff:
+            self.pieces.append(REFERENCE + _USHORT.pack(index))
+            return True
+        self.references[id(value)] = len(self.references)
+        return False
+
+    def _write_null(self, value):
+        self.pieces.append(NULL)
+
+    def _write_undefined(self, value):
+        self.pieces.append(UNDEFINED)
+
+    def _write_bool(self, value):
+        if value:
+            self.pieces.append('\x01\x01')
+        else:
+            self.pieces.append('\x01\x00')
+
+    def _write_number(self, value):
+        self.pieces.append(NUMBER + _DOUBLE.pack(float(value)))
+
+    def _write_string(self, value):
+        data = encode_string(value)
+        if len(data) > 0xffff + 2:
+            self.pieces.append(LONG_STRING)
+        else:
+            self.pieces.append(STRING)
+        self.pieces.append(data)
+
+    def _write_list(self, value):
+        if self._write_reference(value):
+            return
+        self.pieces.append(ARRAY + _ULONG.pack(len(value)))
+        for item in value:
+            self.write_element(item)
+
+    def _write_attributes(self, attrs):
+        for key, item in attrs.iteritems():
+            if type(key) in (int, long):
+                key = str(key)
+            self.pieces.append(encode_string(key))
+            self.write_element(item)
+        self.pieces.append('\x00\x00' + OBJECT_TERM)
+
+    def _write_object(self, value):
+        if self._write_reference(value):
+            return
+        self.pieces.append(OBJECT)
+        # Like pyamf, encode a copy of the dict (this determines the order of
+        # the attributes).
+        self._write_attributes(dict(value))
+
+    def _write_mixed_array(self, value):
+        if self._write_reference(value):
+            return
+        max_index = 0
+        for key in value:
+            if isinstance(key, (int, long)) and key > max_index:
+                max_index = key
+        self.pieces.append(MIXED_ARRAY + _ULONG.pack(max_index))
+        self._write_attributes(value)
+
+    _writers = {
+        type(None): _write_null,
+        UndefinedType: _write_undefined,
+        bool: _write_bool,
+        int: _write_number,
+        long: _write_number,
+        float: _write_number,
+        str: _write_string,
+        unicode: _write_string,
+        list: _write_list,
+        tuple: _write_list,
+        dict: _write_object,
+        ASObject: _write_object,
+        MixedArray: _write_mixed_array,
+    }
+
+class Decoder(object):
+    """
+    Decodes AMF0 values from a buffer. The values read by a decoder share a
+    reference table, like the values read by a pyamf decoder.
+
+    A str or bytearray (e.g. the reassembly buffer of a received message) is
+    decoded in place: a buffer object over it returns the values that are
+    read as str slices. A memoryview has to be copied, buffer() does not
+    accept it.
+    """
+
+    def __init__(self, buf, pos=0):
+        if isinstance(buf, memoryview):
+            buf = buf.tobytes()
+        elif not isinstance(buf, str):
+            buf = buffer(buf)
+        self.data = buf
+        self.pos = pos
+        self.objects = []
+
+    def at_eof(self):
+        return self.pos >= len(self.data)
+
+    def tell(self):
+        return self.pos
+
+    def read(self, length):
+        """ Read raw bytes. """
+        pos = self.pos
+        end = pos + length
+        if end > len(self.data):
+            raise IOError('Attempted to read %d bytes from the buffer but only '
+                '%d remain' % (length, len(self.data) - pos))
+        self.pos = end
+        return self.data[pos:end]
+
+    def read_uchar(self):
+        return ord(self.read(1))
+
+    def read_ushort(self):
+        return _USHORT.unpack(self.read(2))[0]
+
+    def read_ulong(self):
+        return _ULONG.unpack(self.read(4))[0]
+
+    def read_string(self):
+        """ Read a string without a type marker. """
+        return _decode_string(self._read_bytes())
+
+    def _read_bytes(self):
+        """ Read bytes prefixed with their length (an unsigned short). """
+        data = self.data
+        pos = self.pos + 2
+        if pos <= len(data):
+            end = pos + _USHORT.unpack_from(data, pos - 2)[0]
+            if end <= len(data):
+                self.pos = end
+                return data[pos:end]
+        # Let read() raise the error.
+        return self.read(self.read_ushort())
+
+    def read_element(self):
+        """ Read a value with its type marker. """
+        pos = self.pos
+        marker = self.data[pos:pos + 1]
+        reader = self._readers.get(marker)
+        if reader is None:
+            marker = self.read(1)
+            raise UnsupportedType(hex(ord(marker)))
+        self.pos = pos + 1
+        return reader(self)
+
+    def _read_number(self):
+        pos = self.pos
+        if pos + 8 > len(self.data):
+            self.read(8)
+        value = _DOUBLE.unpack_from(self.data, pos)[0]
+        self.pos = pos + 8
+        # Numbers that are integers are returned as ints, like in pyamf.
+        try:
+            integer = int(value)
+        except (OverflowError, ValueError):
+            return value
+        if value == value and integer == value:
+            return integer
+        return value
+
+    def _read_bool(self):
+        return self.read(1) != '\x00'
+
+    def _read_long_string(self):
+        return _decode_string(self.read(_ULONG.unpack(self.read(4))[0]))
+
+    def _read_null(self):
+        return None
+
+    def _read_undefined(self):
+        return Undefined
+
+    def _read_reference(self):
+        index = _USHORT.unpack(self.read(2))[0]
+        if index >= len(self.objects):
+            raise IOError('Unknown reference %d' % index)
+        return self.objects[index]
+
+    def _read_attributes(self):
+        attrs = {}
+        read_bytes = self._read_bytes
+        read_element = self.read_element
+        data = self.data
+        key = intern(read_bytes())
+        while data[self.pos:self.pos + 1] != OBJECT_TERM:
+            attrs[key] = read_element()
+            key = intern(read_bytes())
+        # Skip the end marker.
+        self.pos += 1
+        return attrs
+
+    def _read_object(self):
+        obj = ASObject()
+        self.objects.append(obj)
+        obj.update(self._read_attributes())
+        return obj
+
+    def _read_mixed_array(self):
+        self.read(4)
+        obj = MixedArray()
+        self.objects.append(obj)
+        for key, value in self._read_attributes().iteritems():
+            try:
+                key = int(key)
+            except ValueError:
+                pass
+            obj[key] = value
+        return obj
+
+    def _read_list(self):
+        obj = []
+        self.objects.append(obj)
+        read_element = self.read_element
+        for i in xrange(_ULONG.unpack(self.read(4))[0]):
+            obj.append(read_element())
+        return obj
+
+    # The pyamf decoder interface.
+    readElement = read_element
+    readString = read_string
+
+    _readers = {
+        NUMBER: _read_number,
+        BOOL: _read_bool,
+        STRING: read_string,
+        OBJECT: _read_object,
+        NULL: _read_null,
+        UNDEFINED: _read_undefined,
+        REFERENCE: _read_reference,
+        MIXED_ARRAY: _read_mixed_array,
+        ARRAY: _read_list,
+        LONG_STRING: _read_long_string,
+        UNSUPPORTED: _read_null,
+    }
+
+def encode(*values):
+    """ Encode the values back to back. """
+    encoder = Encoder()
+    for value in values:
+        encoder.write_element(value)
+    return encoder.getvalue()
+
+def decode(buf):
+    """ Decode all the values found in the buffer. """
+    decoder = Decoder(buf)
+    values = []
+    while not decoder.at_eof():
+        values.append(decoder.read_element())
+    return values
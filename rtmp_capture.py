@@ -0,0 +1,333 @@
+"""
+Capture of the raw bytes of RTMP connections to files, and replay of the
+captures through RtmpReader, to profile the parser and the server with
+realistic and deterministic workloads.
+
+A capture file starts with a header (magic and start time) that is followed
+by records of the data read from or written to the connection: the
+direction, the time since the start of the capture and the length of the
+data, followed by the data. Consecutive reads (or writes) within
+coalesce_interval seconds are coalesced into one record, so that the many
+small reads of a parser do not make a record each. When the capture is
+closed, an index of the time and offset of every index_interval-th record is
+appended, followed by a trailer that locates it. Captures without an index
+(e.g. of a process that was killed) can still be replayed, their records are
+scanned.
+
+Usage:
+    python rtmp_capture.py FILE [--sent] [--speed SPEED]
+
+replays a capture as fast as possible (or at SPEED times the original pace)
+and reports the rate at which the messages were read.
+"""
+
+import argparse
+import bisect
+import mmap
+import struct
+import time
+
+import pyamf.util.pure
+import rtmp_protocol
+import rtmp_protocol_base
+
+MAGIC = 'RTMPCAP1'
+INDEX_MAGIC = 'RTMPIDX1'
+
+# Directions of the records.
+RECEIVED = 0
+SENT = 1
+
+# Both peers send their version and two handshake packets before the first
+# chunk.
+HANDSHAKE_SIZE = 1 + 2 * rtmp_protocol_base.HANDSHAKE_LENGTH
+
+_FILE_HEADER = struct.Struct('!8sd')
+_RECORD_HEADER = struct.Struct('!BdL')
+_INDEX_ENTRY = struct.Struct('!dQ')
+_TRAILER = struct.Struct('!QL8s')
+
+class CaptureError(Exception):
+    """ Raised for files that are not captures. """
+
+class CaptureWriter:
+    """
+    Writes the data of a connection to a capture file. The data is passed to
+    record() by the connection, or recorded by the file object wrapper
+    returned by wrap(). The data of the current record is kept in memory
+    until the direction changes, coalesce_interval seconds have elapsed since
+    the record started or max_record_size bytes are pending.
+    """
+
+    def __init__(self, path, index_interval=64, coalesce_interval=0.01,
+                 max_record_size=65536):
+        self.file = open(path, 'wb')
+        self.start = time.time()
+        self.file.write(_FILE_HEADER.pack(MAGIC, self.start))
+        self.offset = _FILE_HEADER.size
+        self.records = 0
+        self.index = []
+        self.index_interval = index_interval
+        self.coalesce_interval = coalesce_interval
+        self.max_record_size = max_record_size
+        self.pending_direction = None
+        self.pending_time = 0
+        self.pending = bytearray()
+
+    def record(self, direction, data):
+        """ Record data received or sent (RECEIVED or SENT) right now. """
+        if not data or self.file is None:
+            return
+        elapsed = time.time() - self.start
+        if direction != self.pending_direction or \
+                elapsed - self.pending_time >= self.coalesce_interval or \
+                len(self.pending) >= self.max_record_size:
+            self.write_pending()
+            self.pending_direction = direction
+            self.pending_time = elapsed
+        self.pending += data
+
+    def write_pending(self):
+        """ Write the pending data as a record. """
+        if not self.pending:
+            return
+        if self.records % self.index_interval == 0:
+            self.index.append((self.pending_time, self.offset))
+        self.file.write(_RECORD_HEADER.pack(self.pending_direction,
+            self.pending_time, len(self.pending)))
+        self.file.write(self.pending)
+        self.offset += _RECORD_HEADER.size + len(self.pending)
+        self.records += 1
+        self.pending = bytearray()
+
+    def wrap(self, fileobject):
+        """
+        Return a wrapper of a file object (e.g. of a socket) that records the
+        data read from and written to it.
+        """
+        return CaptureFile(fileobject, self)
+
+    def close(self):
+        """ Write the pending data and the index and close the file. """
+        if self.file is None:
+            return
+        self.write_pending()
+        for elapsed, offset in self.index:
+            self.file.write(_INDEX_ENTRY.pack(elapsed, offset))
+        self.file.write(_TRAILER.pack(self.offset, len(self.index),
+            INDEX_MAGIC))
+        self.file.close()
+        self.file = None
+
+class CaptureFile:
+    """
+    A file object wrapper that records the data read from and written to the
+    wrapped file object, e.g. the one that FileDataTypeMixIn uses.
+    """
+
+    def __init__(self, fileobject, capture):
+        self.fileobject = fileobject
+        self.capture = capture
+
+    def read(self, size=-1):
+        data = self.fileobject.read(size)
+        self.capture.record(RECEIVED, data)
+        return data
+
+    def write(self, data):
+        self.fileobject.write(data)
+        self.capture.record(SENT, data)
+
+    def flush(self):
+        self.fileobject.flush()
+
+    def close(self):
+        self.fileobject.close()
+        self.capture.close()
+
+class CaptureReader:
+    """
+    Reads a capture file. The file is memory-mapped and the data of the
+    records is returned as buffers over the mapping, without copying it.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < _FILE_HEADER.size:
+            raise CaptureError('%s is not a capture file' % path)
+        magic, self.start = _FILE_HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise CaptureError('%s is not a capture file' % path)
+        self.end, self.index = self.read_index()
+        self.times = [elapsed for elapsed, offset in self.index]
+
+    def read_index(self):
+        """
+        Return the offset of the end of the records and the index of the
+        capture (an empty one if it was not closed).
+        """
+        size = len(self.map)
+        if size >= _FILE_HEADER.size + _TRAILER.size:
+            index_offset, count, magic = _TRAILER.unpack_from(self.map,
+                size - _TRAILER.size)
+            if magic == INDEX_MAGIC and index_offset + \
+                    count * _INDEX_ENTRY.size + _TRAILER.size == size:
+                return index_offset, [_INDEX_ENTRY.unpack_from(self.map,
+                    index_offset + i * _INDEX_ENTRY.size)
+                    for i in xrange(count)]
+        return size, []
+
+    def records(self, direction=None, start_time=0):
+        """
+        Yield the direction, time and data of the records of one direction
+        (or of both) from start_time on. The index is used to find the first
+        record.
+        """
+        offset = _FILE_HEADER.size
+        i = bisect.bisect_right(self.times, start_time) - 1
+        if i >= 0:
+            offset = self.index[i][1]
+        while offset + _RECORD_HEADER.size <= self.end:
+            record_direction, elapsed, length = _RECORD_HEADER.unpack_from(
+                self.map, offset)
+            data_offset = offset + _RECORD_HEADER.size
+            # A truncated record ends a capture that was not closed.
+            if data_offset + length > self.end:
+                break
+            offset = data_offset + length
+            if elapsed < start_time:
+                continue
+            if direction is None or record_direction == direction:
+                yield record_direction, elapsed, buffer(self.map, data_offset,
+                    length)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+class ReplayStream(pyamf.util.pure.DataTypeMixIn):
+    """
+    A stream over the data of capture records, for RtmpReader. If speed is
+    given, the data of every record can only be read once its time (divided
+    by speed) has elapsed since the start of the replay, otherwise the
+    records are read as fast as possible.
+    """
+
+    def __init__(self, records, speed=None):
+        """ records yields the time and data of the records to replay. """
+        self.records = iter(records)
+        self.speed = speed
+        self.replay_start = None
+        self.data = ''
+        self.pos = 0
+        pyamf.util.pure.DataTypeMixIn.__init__(self)
+
+    def advance(self):
+        """
+        Move to the next record, waiting for its time if the replay is paced.
+        Return False if there are no more records.
+        """
+        try:
+            elapsed, data = next(self.records)
+        except StopIteration:
+            return False
+        if self.speed:
+            if self.replay_start is None:
+                self.replay_start = time.time() - elapsed / self.speed
+            delay = self.replay_start + elapsed / self.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        self.data = data
+        self.pos = 0
+        return True
+
+    def read(self, length):
+        data = self.data
+        pos = self.pos
+        if pos + length <= len(data):
+            self.pos = pos + length
+            return data[pos:pos + length]
+
+        pieces = []
+        remaining = length
+        while remaining:
+            available = len(self.data) - self.pos
+            if not available:
+                if not self.advance():
+                    raise IOError('Tried to read %d byte(s) from the capture'
+                        % length)
+                continue
+            size = min(available, remaining)
+            pieces.append(self.data[self.pos:self.pos + size])
+            self.pos += size
+            remaining -= size
+        return ''.join(pieces)
+
+    def readinto(self, buf):
+        buf[:] = self.read(len(buf))
+        return len(buf)
+
+    def at_eof(self):
+        while self.pos >= len(self.data):
+            if not self.advance():
+                return True
+        return False
+
+def replay(path, direction=RECEIVED, speed=None, skip_handshake=True):
+    """
+    Yield the messages of one direction of a capture, read by an RtmpReader.
+    The direction is RECEIVED or SENT from the point of view of the captured
+    peer. With speed (e.g. 1.0), the messages are yielded at the pace at
+    which their data was captured, otherwise as fast as possible.
+    """
+    capture = CaptureReader(path)
+    try:
+        stream = ReplayStream(((elapsed, data) for record_direction, elapsed,
+            data in capture.records(direction)), speed)
+        if skip_handshake:
+            try:
+                stream.read(HANDSHAKE_SIZE)
+            except IOError:
+                # The capture ends during the handshake.
+                return
+        reader = rtmp_protocol.RtmpReader(stream)
+        while True:
+            try:
+                message = reader.next()
+            except StopIteration:
+                break
+            except IOError:
+                # The last message of a capture that was not closed may be
+                # incomplete.
+                if stream.at_eof():
+                    break
+                raise
+            if message.datatype == rtmp_protocol.DataTypes.SET_CHUNK_SIZE:
+                reader.chunk_size = message.chunk_size
+            yield message
+    finally:
+        capture.close()
+
+def main():
+    """ Replay a capture from the command line. """
+    parser = argparse.ArgumentParser(
+        description='Replay a capture through RtmpReader.')
+    parser.add_argument('path', help='the capture file')
+    parser.add_argument('--sent', action='store_true',
+        help='replay the data sent by the captured peer')
+    parser.add_argument('--speed', type=float,
+        help='replay at SPEED times the original pace')
+    args = parser.parse_args()
+
+    direction = SENT if args.sent else RECEIVED
+    start = time.time()
+    count = 0
+    for message in replay(args.path, direction, args.speed):
+        count += 1
+    elapsed = time.time() - start
+    print '%d messages in %.3f seconds (%.1f messages/sec)' % (count,
+        elapsed, count / max(elapsed, 1e-9))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+"""
+Recording of audio, video and data messages to FLV files and playback of FLV
+files (video on demand) through RtmpWriter.
+
+FlvWriter writes the messages of a published stream, e.g. as they are read by
+an RtmpReader. FlvReader memory-maps an FLV file and keeps an index of its
+seek points (the video keyframes, or one audio tag per second in files
+without video), so that seeking is a binary search. The index is built by
+FlvWriter as it records or by scanning the file, and is cached next to the
+file. FlvPlayback plays a file to one viewer: the tags are sent straight from
+the memory map, their payloads are not copied, and the readers are shared by
+all the viewers of a file (see open_flv), so a viewer costs little memory.
+"""
+
+import bisect
+import logging
+import mmap
+import os
+import struct
+
+import rtmp_protocol
+
+FLV_HEADER = 'FLV\x01\x05\x00\x00\x00\x09'
+INDEX_MAGIC = 'FLVIDX1\x00'
+
+# Interval of the seek points of files without video, in milliseconds.
+AUDIO_SEEK_INTERVAL = 1000
+
+_TAG_HEADER = struct.Struct('!BBHBHBBH')
+_TAG_SIZE = struct.Struct('!L')
+_INDEX_HEADER = struct.Struct('!8sQdLL')
+_CONFIG_ENTRY = struct.Struct('!Q')
+_INDEX_ENTRY = struct.Struct('!LQ')
+
+# The FLV readers shared by the viewers, keyed by path.
+_flv_readers = {}
+
+class FlvError(Exception):
+    """ Raised for files that are not FLV files (including empty files). """
+
+def is_keyframe(tag_type, data):
+    """ Return whether a tag is a video keyframe. """
+    return tag_type == rtmp_protocol.DataTypes.VIDEO and len(data) > 0 and \
+        ord(data[0]) >> 4 == 1
+
+def is_sequence_header(tag_type, data):
+    """
+    Return whether a tag holds the decoder configuration of an AVC video or
+    AAC audio stream, which a viewer needs before any other tag.
+    """
+    if len(data) < 2 or data[1] != '\x00':
+        return False
+    if tag_type == rtmp_protocol.DataTypes.VIDEO:
+        return ord(data[0]) & 0x0f == 7
+    if tag_type == rtmp_protocol.DataTypes.AUDIO:
+        return ord(data[0]) >> 4 == 10
+    return False
+
+class SeekIndex:
+    """
+    The seek points of an FLV file (timestamp and offset of a tag) and the
+    offsets of its decoder configuration tags and metadata.
+    """
+
+    def __init__(self):
+        self.config_offsets = []
+        self.entries = []
+        self.has_video = False
+        self.last_audio_point = None
+
+    def add_tag(self, tag_type, data, timestamp, offset):
+        """ Update the index with the tag found at offset. """
+        DataTypes = rtmp_protocol.DataTypes
+        if tag_type == DataTypes.DATA or is_sequence_header(tag_type, data):
+            self.config_offsets.append(offset)
+        elif is_keyframe(tag_type, data):
+            if not self.has_video:
+                # Audio seek points are dropped once video shows up.
+                self.has_video = True
+                self.entries = []
+            self.entries.append((timestamp, offset))
+        elif tag_type == DataTypes.AUDIO and not self.has_video:
+            if self.last_audio_point is None or \
+                    timestamp - self.last_audio_point >= AUDIO_SEEK_INTERVAL:
+                self.last_audio_point = timestamp
+                self.entries.append((timestamp, offset))
+
+    def save(self, flv_path):
+        """
+        Cache the index next to the FLV file. The cache is only valid for the
+        current size and modification time of the file. It is written to a
+        temporary file that is then renamed, so that another process never
+        loads a half-written cache.
+        """
+        stat = os.stat(flv_path)
+        path = flv_path + '.idx'
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(_INDEX_HEADER.pack(INDEX_MAGIC, stat.st_size,
+                    stat.st_mtime, len(self.config_offsets),
+                    len(self.entries)))
+                for offset in self.config_offsets:
+                    f.write(_CONFIG_ENTRY.pack(offset))
+                for timestamp, offset in self.entries:
+                    f.write(_INDEX_ENTRY.pack(timestamp, offset))
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    @classmethod
+    def load(cls, flv_path):
+        """ Return the cached index of an FLV file, None if it is stale. """
+        try:
+            with open(flv_path + '.idx', 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        if len(data) < _INDEX_HEADER.size:
+            return None
+        magic, size, mtime, config_count, count = \
+            _INDEX_HEADER.unpack_from(data)
+        stat = os.stat(flv_path)
+        if magic != INDEX_MAGIC or size != stat.st_size or \
+                mtime != stat.st_mtime or len(data) != _INDEX_HEADER.size + \
+                config_count * _CONFIG_ENTRY.size + count * _INDEX_ENTRY.size:
+            return None
+        index = cls()
+        pos = _INDEX_HEADER.size
+        for i in xrange(config_count):
+            index.config_offsets.append(_CONFIG_ENTRY.unpack_from(data, pos)[0])
+            pos += _CONFIG_ENTRY.size
+        for i in xrange(count):
+            index.entries.append(_INDEX_ENTRY.unpack_from(data, pos))
+            pos += _INDEX_ENTRY.size
+        return index
+
+class FlvWriter:
+    """
+    Records the audio, video and data messages of a stream to an FLV file.
+    The timestamps of the file start at the timestamp of the first message.
+    The seek index is saved next to the file when it is closed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(FLV_HEADER + _TAG_SIZE.pack(0))
+        self.offset = len(FLV_HEADER) + _TAG_SIZE.size
+        self.base_timestamp = None
+        self.index = SeekIndex()
+
+    def write(self, message):
+        """
+        Write a message as an FLV tag. Returns False for the messages that
+        FLV files do not hold (anything but audio, video and data).
+        """
+        datatype = message.datatype
+        if datatype not in (rtmp_protocol.DataTypes.AUDIO,
+                rtmp_protocol.DataTypes.VIDEO, rtmp_protocol.DataTypes.DATA):
+            return False
+        body = rtmp_protocol.encode_message_body(message)
+        if isinstance(body, memoryview):
+            body = body.tobytes()
+        timestamp = getattr(message, 'timestamp', 0)
+        if self.base_timestamp is None:
+            self.base_timestamp = timestamp
+        timestamp = max(0, timestamp - self.base_timestamp) & 0xffffffff
+
+        size = len(body)
+        self.file.write(_TAG_HEADER.pack(datatype, size >> 16, size & 0xffff,
+            (timestamp >> 16) & 0xff, timestamp & 0xffff, timestamp >> 24,
+            0, 0))
+        self.file.write(body)
+        self.file.write(_TAG_SIZE.pack(_TAG_HEADER.size + size))
+        self.index.add_tag(datatype, str(body[:2]), timestamp, self.offset)
+        self.offset += _TAG_HEADER.size + size + _TAG_SIZE.size
+        return True
+
+    def write_messages(self, messages):
+        """
+        Write the messages that FLV files hold, e.g. those of an RtmpReader.
+        Returns the number of tags written.
+        """
+        count = 0
+        for message in messages:
+            if self.write(message):
+                count += 1
+        return count
+
+    def close(self):
+        """ Close the file and save its seek index. """
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        self.index.save(self.path)
+
+class FlvReader:
+    """
+    Reads the tags of a memory-mapped FLV file. The data of the tags is
+    returned as buffers over the mapping, without copying it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        # The file that is mapped, even if path is replaced later.
+        stat = os.fstat(self.file.fileno())
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        try:
+            # An empty file cannot be mapped.
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise FlvError('%s is not an FLV file' % path)
+        if self.map[:3] != 'FLV' or len(self.map) < 13:
+            self.close()
+            raise FlvError('%s is not an FLV file' % path)
+        self.data_offset = _TAG_SIZE.unpack_from(self.map, 5)[0] + \
+            _TAG_SIZE.size
+        self.index = SeekIndex.load(path)
+        if self.index is None:
+            self.index = self.build_index()
+            # The index is only cached to speed up the next open.
+            try:
+                self.index.save(path)
+            except (IOError, OSError) as e:
+                logging.warning('Could not cache the seek index of %s: %s',
+                    path, e)
+        self.times = [timestamp for timestamp, offset in self.index.entries]
+
+    def tag_at(self, offset):
+        """
+        Return the type, timestamp and data of the tag at offset and the
+        offset of the next tag, or None if there is no complete tag there.
+        """
+        if offset + _TAG_HEADER.size > len(self.map):
+            return None
+        tag_type, size_high, size_low, time_high, time_low, time_ext, \
+            stream_high, stream_low = _TAG_HEADER.unpack_from(self.map, offset)
+        size = (size_high << 16) | size_low
+        data_offset = offset + _TAG_HEADER.size
+        next_offset = data_offset + size + _TAG_SIZE.size
+        if next_offset > len(self.map):
+            return None
+        timestamp = (time_ext << 24) | (time_high << 16) | time_low
+        return tag_type, timestamp, buffer(self.map, data_offset, size), \
+            next_offset
+
+    def tags(self, offset=None):
+        """
+        Yield the type, timestamp, data and next offset of the tags from
+        offset on (from the first tag by default).
+        """
+        if offset is None:
+            offset = self.data_offset
+        tag_at = self.tag_at
+        while True:
+            tag = tag_at(offset)
+            if tag is None:
+                return
+            yield tag
+            offset = tag[3]
+
+    def build_index(self):
+        """ Scan the file for its seek points. """
+        index = SeekIndex()
+        offset = self.data_offset
+        for tag_type, timestamp, data, next_offset in self.tags():
+            index.add_tag(tag_type, data[:2], timestamp, offset)
+            offset = next_offset
+        return index
+
+    def seek(self, timestamp):
+        """
+        Return the offset of the last seek point at or before the timestamp
+        (of the first tag if there is none).
+        """
+        i = bisect.bisect_right(self.times, timestamp) - 1
+        if i < 0:
+            return self.data_offset
+        return self.index.entries[i][1]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+def open_flv(path):
+    """
+    Return the shared reader of an FLV file. A new reader is opened if the
+    size or the modification time of the file changed since the shared one
+    was opened, and the old one is closed.
+    """
+    reader = _flv_readers.get(path)
+    if reader is not None:
+        stat = os.stat(path)
+        if stat.st_size == reader.size and stat.st_mtime == reader.mtime:
+            return reader
+        del _flv_readers[path]
+        reader.close()
+    reader = _flv_readers[path] = FlvReader(path)
+    return reader
+
+def tag_message(tag_type, timestamp, data, stream_id):
+    """ Return the message that sends a tag, its data is not copied. """
+    if tag_type == rtmp_protocol.DataTypes.AUDIO:
+        return rtmp_protocol.AudioMessage(data, timestamp, stream_id)
+    if tag_type == rtmp_protocol.DataTypes.VIDEO:
+        return rtmp_protocol.VideoMessage(data, timestamp, stream_id)
+    return rtmp_protocol.DataMessage(timestamp=timestamp, stream_id=stream_id,
+        body=data)
+
+class FlvPlayback:
+    """
+    Plays an FLV file to one viewer through an RtmpWriter: the state of a
+    viewer is a position in a reader that is shared by all the viewers. The
+    owner of the playback paces it by calling send() with the timestamp up to
+    which the tags are due.
+    """
+
+    def __init__(self, flv, writer, stream_id=1):
+        self.flv = flv
+        self.writer = writer
+        self.stream_id = stream_id
+        self.offset = None
+        self.seek(0)
+
+    def seek(self, timestamp):
+        """
+        Continue the playback from the last seek point at or before the
+        timestamp. The metadata and the decoder configuration are sent again
+        before the next tags.
+        """
+        self.offset = self.flv.seek(timestamp)
+        self.config_sent = False
+
+    def send(self, until=None):
+        """
+        Write the tags up to the timestamp until (all of them if None). Returns
+        False once the end of the file has been reached.
+        """
+        flv = self.flv
+        writer = self.writer
+        if not self.config_sent:
+            self.config_sent = True
+            for offset in flv.index.config_offsets:
+                tag = flv.tag_at(offset)
+                if tag is not None and offset < self.offset:
+                    writer.write(tag_message(tag[0], tag[1], tag[2],
+                        self.stream_id))
+        while True:
+            tag = flv.tag_at(self.offset)
+            if tag is None:
+                return False
+            tag_type, timestamp, data, next_offset = tag
+            if until is not None and timestamp > until:
+                return True
+            writer.write(tag_message(tag_type, timestamp, data,
+                self.stream_id))
+            self.offset = next_offset
@@ -0,0 +1,181 @@
+"""
+Metrics of RTMP connections. A MetricsCollector is attached to readers,
+writers, connection engines, clients or servers (their metrics attribute);
+they call it for every chunk, message, handshake and queued message. Nothing
+is collected, and nothing is spent on collecting, while no collector is
+attached.
+
+A collector is usually shared by all the connections of a process. Its
+snapshot can be written as JSON on demand by a JsonExporter.
+"""
+
+import json
+import os
+import signal
+import time
+
+import rtmp_protocol
+
+# Names of the message datatypes, used in the snapshots.
+DATATYPE_NAMES = dict((value, name.lower())
+    for name, value in vars(rtmp_protocol.DataTypes).iteritems()
+    if not name.startswith('_'))
+
+class Histogram:
+    """
+    Counts values in buckets whose upper bounds are the powers of two. Times
+    are observed in microseconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def observe(self, value):
+        """ Add a value (a non-negative number). """
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        bucket = int(value).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def snapshot(self):
+        """
+        Return the histogram as a dict. The buckets are [upper bound, count]
+        pairs: the values of a bucket are less than its upper bound and at
+        least the upper bound of the previous bucket.
+        """
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'buckets': [[2 ** bucket, self.buckets[bucket]]
+                for bucket in sorted(self.buckets)],
+        }
+
+class MetricsCollector:
+    """
+    Collects the traffic counters (bytes, chunks and messages per datatype in
+    both directions), the time spent decoding and encoding messages, the
+    handshake durations and the depths of the outbound message queues.
+
+    Decode times cover the decoding done by the reader when a message is
+    completed; AMF payloads are decoded later, when they are first accessed.
+    Counters are updated without locking: a collector shared by several
+    threads may lose a few updates, which is accepted for metrics.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.chunks_received = 0
+        self.chunks_sent = 0
+        self.messages_received = {}
+        self.messages_sent = {}
+        self.message_bytes_received = 0
+        self.message_bytes_sent = 0
+        self.decode_time = Histogram()
+        self.encode_time = Histogram()
+        self.handshake_time = Histogram()
+        self.queue_depth = Histogram()
+        self.handshakes = 0
+
+    def received(self, byte_count):
+        """ Called with the number of bytes received from the network. """
+        self.bytes_received += byte_count
+
+    def sent(self, byte_count):
+        """ Called with the number of bytes sent to the network. """
+        self.bytes_sent += byte_count
+
+    def chunk_received(self):
+        self.chunks_received += 1
+
+    def message_received(self, datatype, body_len, seconds):
+        """
+        Called for every message decoded by a reader, with the length of its
+        body and the time it took to decode it.
+        """
+        self.messages_received[datatype] = \
+            self.messages_received.get(datatype, 0) + 1
+        self.message_bytes_received += body_len
+        self.decode_time.observe(seconds * 1e6)
+
+    def message_encoded(self, seconds):
+        """ Called with the time it took to encode the body of a message. """
+        self.encode_time.observe(seconds * 1e6)
+
+    def message_sent(self, datatype, body_len, chunks):
+        """
+        Called for every message written by a writer, with the length of its
+        body and the number of chunks it was split into.
+        """
+        self.messages_sent[datatype] = self.messages_sent.get(datatype, 0) + 1
+        self.message_bytes_sent += body_len
+        self.chunks_sent += chunks
+
+    def handshake_completed(self, seconds):
+        """ Called with the duration of every completed handshake. """
+        self.handshakes += 1
+        self.handshake_time.observe(seconds * 1e6)
+
+    def message_queued(self, depth):
+        """
+        Called when a message is queued for a congested peer, with the depth
+        of the queue.
+        """
+        self.queue_depth.observe(depth)
+
+    def snapshot(self):
+        """ Return all the metrics as a dict that can be encoded as JSON. """
+        return {
+            'time': time.time(),
+            'uptime': time.time() - self.started,
+            'bytes_received': self.bytes_received,
+            'bytes_sent': self.bytes_sent,
+            'chunks_received': self.chunks_received,
+            'chunks_sent': self.chunks_sent,
+            'messages_received': self._by_name(self.messages_received),
+            'messages_sent': self._by_name(self.messages_sent),
+            'message_bytes_received': self.message_bytes_received,
+            'message_bytes_sent': self.message_bytes_sent,
+            'handshakes': self.handshakes,
+            'decode_time_us': self.decode_time.snapshot(),
+            'encode_time_us': self.encode_time.snapshot(),
+            'handshake_time_us': self.handshake_time.snapshot(),
+            'queue_depth': self.queue_depth.snapshot(),
+        }
+
+    def _by_name(self, counts):
+        return dict((DATATYPE_NAMES.get(datatype, str(datatype)), count)
+            for datatype, count in counts.items())
+
+class JsonExporter:
+    """
+    Writes snapshots of a collector to a JSON file, on demand: when export()
+    is called or, once install() has been called, when the process receives a
+    signal (SIGUSR1 by default). The file is replaced atomically.
+    """
+
+    def __init__(self, collector, path):
+        self.collector = collector
+        self.path = path
+
+    def export(self):
+        """ Write a snapshot of the collector to the file. """
+        tmp_path = '%s.tmp%d' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.collector.snapshot(), f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def install(self, signum=signal.SIGUSR1):
+        """ Export a snapshot whenever the process receives the signal. """
+        signal.signal(signum, lambda signum, frame: self.export())
@@ -5,25 +5,99 @@ clients.
 
 import pyamf.amf0
 import pyamf.util.pure
+import rtmp_amf0
 import rtmp_protocol_base
+import io
+import select
 import socket
+import struct
+import threading
+import time
 import logging
 
 class FileDataTypeMixIn(pyamf.util.pure.DataTypeMixIn):
     """
     Provides a wrapper for a file object that enables reading and writing of raw
     data types for the file.
+
+    If a metrics collector is attached (see rtmp_metrics), it is called with
+    the number of bytes of every read and write.
     """
 
-    def __init__(self, fileobject):
+    metrics = None
+
+    def __init__(self, fileobject, sock=None):
+        """
+        Wrap a file object. If the file object is the file of a socket, the
+        socket can be given too: messages are then sent on it directly,
+        without the copies made by the buffer of the file object.
+        """
         self.fileobject = fileobject
+        self.sock = sock
+        self.bytes_read = 0
         pyamf.util.pure.DataTypeMixIn.__init__(self)
 
     def read(self, length):
-        return self.fileobject.read(length)
+        data = self.fileobject.read(length)
+        self.bytes_read += len(data)
+        if self.metrics is not None:
+            self.metrics.received(len(data))
+        return data
+
+    def readinto(self, buf):
+        """
+        Read exactly len(buf) bytes into the writable buffer buf (e.g. a
+        memoryview over a bytearray). The data is read in place when the file
+        object supports readinto.
+        """
+        readinto = getattr(self.fileobject, 'readinto', None)
+        length = len(buf)
+        pos = 0
+        while pos < length:
+            if readinto is not None:
+                read_bytes = readinto(buf[pos:])
+            else:
+                data = self.fileobject.read(length - pos)
+                read_bytes = len(data)
+                buf[pos:pos + read_bytes] = data
+            if not read_bytes:
+                raise IOError('Tried to read %d byte(s) from the stream' %
+                    length)
+            pos += read_bytes
+            self.bytes_read += read_bytes
+        if self.metrics is not None:
+            self.metrics.received(length)
+        return length
 
     def write(self, data):
         self.fileobject.write(data)
+        if self.metrics is not None:
+            self.metrics.sent(len(data))
+
+    def writev(self, pieces):
+        """
+        Write a list of byte strings and buffers (e.g. memoryview slices) with
+        a single call. The pieces are copied once: straight into the buffer of
+        an io file object (e.g. io.BytesIO), otherwise into one bytearray that
+        is sent on the socket or written to the file object.
+        """
+        fileobject = self.fileobject
+        if isinstance(fileobject, io.IOBase):
+            fileobject.writelines(pieces)
+            if self.metrics is not None:
+                self.metrics.sent(sum(len(piece) for piece in pieces))
+            return
+        data = bytearray()
+        for piece in pieces:
+            data += piece
+        if self.sock is not None:
+            # Data written before (e.g. the handshake) goes out first.
+            fileobject.flush()
+            self.sock.sendall(data)
+        else:
+            fileobject.write(data)
+        if self.metrics is not None:
+            self.metrics.sent(len(data))
 
     def flush(self):
         self.fileobject.flush()
@@ -31,13 +105,69 @@ class FileDataTypeMixIn(pyamf.util.pure.DataTypeMixIn):
     def at_eof(self):
         return False
 
+class MemoryViewDataTypeMixIn(pyamf.util.pure.DataTypeMixIn):
+    """
+    Provides a read-only stream over a memoryview that enables reading of raw
+    data types (and AMF decoding) without copying the underlying buffer.
+    """
+
+    def __init__(self, buf):
+        self.view = memoryview(buf)
+        self.pos = 0
+        pyamf.util.pure.DataTypeMixIn.__init__(self)
+
+    def __len__(self):
+        return len(self.view)
+
+    def read(self, length=-1):
+        if length == -1:
+            length = len(self.view) - self.pos
+        elif self.pos + length > len(self.view):
+            raise IOError('Attempted to read %d bytes from the buffer but only '
+                '%d remain' % (length, len(self.view) - self.pos))
+        data = self.view[self.pos:self.pos + length].tobytes()
+        self.pos += length
+        return data
+
+    def readinto(self, buf):
+        length = len(buf)
+        if self.pos + length > len(self.view):
+            raise IOError('Attempted to read %d bytes from the buffer but only '
+                '%d remain' % (length, len(self.view) - self.pos))
+        buf[:] = self.view[self.pos:self.pos + length]
+        self.pos += length
+        return length
+
+    def peek(self, size=1):
+        return self.view[self.pos:self.pos + size].tobytes()
+
+    def seek(self, pos, mode=0):
+        if mode == 1:
+            pos += self.pos
+        elif mode == 2:
+            pos += len(self.view)
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def remaining(self):
+        return len(self.view) - self.pos
+
+    def at_eof(self):
+        return self.pos >= len(self.view)
+
 class DataTypes:
     """ Represents an enumeration of the RTMP message datatypes. """
     NONE = -1
     SET_CHUNK_SIZE = 1
+    ACKNOWLEDGEMENT = 3
     USER_CONTROL = 4
     WINDOW_ACK_SIZE = 5
     SET_PEER_BANDWIDTH = 6
+    AUDIO = 8
+    VIDEO = 9
+    DATA = 18
     SHARED_OBJECT = 19
     COMMAND = 20
 
@@ -61,16 +191,626 @@ class UserControlTypes:
     PING_REQUEST = 6
     PING_RESPONSE = 7
 
+class Record(object):
+    """
+    Base class of the compact (__slots__ based) message and event objects.
+    The names listed in fields can also be accessed as items, so the objects
+    remain usable by code written for the dict form of messages.
+    """
+
+    __slots__ = ()
+    fields = ()
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.fields:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        return list(self.fields)
+
+    def to_dict(self):
+        """ Return the dict form of the object. """
+        ret = {}
+        for key in self.fields:
+            ret[key] = getattr(self, key)
+        return ret
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.to_dict())
+
+def stored_field(name):
+    """
+    Create a property for a field of a lazily decoded message that is kept in
+    the slot '_' + name. Setting the field decodes the rest of the body first
+    and drops the undecoded body, so that the message gets re-encoded.
+    """
+    slot = '_' + name
+
+    def fget(self):
+        return getattr(self, slot)
+
+    def fset(self, value):
+        if self._body is not None:
+            self.decode_body()
+        setattr(self, slot, value)
+
+    return property(fget, fset)
+
+def lazy_field(name):
+    """
+    Create a property for a lazily decoded field of a message that is kept in
+    the slot '_' + name. The body is decoded when the field is first read.
+    """
+    slot = '_' + name
+
+    def fget(self):
+        if self._body is not None:
+            self.decode_body()
+        return getattr(self, slot)
+
+    def fset(self, value):
+        if self._body is not None:
+            self.decode_body()
+        setattr(self, slot, value)
+
+    return property(fget, fset)
+
+class Message(Record):
+    """
+    Base class of the RTMP messages. The datatype of a message is also
+    available as its 'msg' item.
+    """
+
+    __slots__ = ()
+    datatype = DataTypes.NONE
+
+    def __getitem__(self, key):
+        if key == 'msg':
+            return self.datatype
+        return Record.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key == 'msg' or key in self.fields
+
+    def keys(self):
+        return ['msg'] + list(self.fields)
+
+    def to_dict(self):
+        ret = Record.to_dict(self)
+        ret['msg'] = self.datatype
+        return ret
+
+    def raw_body(self):
+        """
+        Return the body that can be sent as is for this message, or None if
+        the message has to be encoded.
+        """
+        return None
+
+class SetChunkSizeMessage(Message):
+    """ Announces the maximum chunk size used by the sender. """
+
+    __slots__ = ('chunk_size',)
+    datatype = DataTypes.SET_CHUNK_SIZE
+    fields = ('chunk_size',)
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+
+class AcknowledgementMessage(Message):
+    """ Acknowledges the number of bytes received so far. """
+
+    __slots__ = ('sequence_number',)
+    datatype = DataTypes.ACKNOWLEDGEMENT
+    fields = ('sequence_number',)
+
+    def __init__(self, sequence_number):
+        self.sequence_number = sequence_number
+
+class UserControlMessage(Message):
+    """ A user control event, e.g. a ping request or a stream begin. """
+
+    __slots__ = ('event_type', 'event_data')
+    datatype = DataTypes.USER_CONTROL
+    fields = ('event_type', 'event_data')
+
+    def __init__(self, event_type, event_data):
+        self.event_type = event_type
+        self.event_data = event_data
+
+class WindowAckSizeMessage(Message):
+    """ Announces the acknowledgement window of the sender. """
+
+    __slots__ = ('window_ack_size',)
+    datatype = DataTypes.WINDOW_ACK_SIZE
+    fields = ('window_ack_size',)
+
+    def __init__(self, window_ack_size):
+        self.window_ack_size = window_ack_size
+
+class SetPeerBandwidthMessage(Message):
+    """ Limits the output bandwidth of the peer. """
+
+    __slots__ = ('window_ack_size', 'limit_type')
+    datatype = DataTypes.SET_PEER_BANDWIDTH
+    fields = ('window_ack_size', 'limit_type')
+
+    def __init__(self, window_ack_size, limit_type):
+        self.window_ack_size = window_ack_size
+        self.limit_type = limit_type
+
+class MediaMessage(Message):
+    """
+    Base class of the audio and video messages. The body is opaque and is
+    never decoded; it is sent as is.
+    """
+
+    __slots__ = ('body', 'timestamp', 'stream_id')
+    fields = ('body', 'timestamp', 'stream_id')
+
+    def __init__(self, body, timestamp=0, stream_id=0):
+        self.body = body
+        self.timestamp = timestamp
+        self.stream_id = stream_id
+
+    def raw_body(self):
+        return self.body
+
+class AudioMessage(MediaMessage):
+    """ An audio message. """
+
+    __slots__ = ()
+    datatype = DataTypes.AUDIO
+
+class VideoMessage(MediaMessage):
+    """ A video message. """
+
+    __slots__ = ()
+    datatype = DataTypes.VIDEO
+
+class LazyMessage(Message):
+    """
+    Base class of the messages with an AMF0 body. A received message keeps
+    its undecoded body and is only decoded when one of its lazy fields is
+    first accessed, or when it is modified. A message that was never decoded
+    is forwarded by RtmpWriter as is, without being re-encoded.
+    """
+
+    __slots__ = ()
+
+    def decoded(self):
+        """ Return whether the body has been decoded. """
+        return self._body is None
+
+    def decode_body(self):
+        """ Decode the lazily decoded fields from the body. """
+        raise NotImplementedError
+
+    def raw_body(self):
+        return self._body
+
+class CommandMessage(LazyMessage):
+    """ A command (remote procedure call or reply). """
+
+    __slots__ = ('_command', '_body', 'timestamp', 'stream_id')
+    datatype = DataTypes.COMMAND
+    fields = ('command', 'timestamp', 'stream_id')
+
+    def __init__(self, command=None, timestamp=0, stream_id=0, body=None):
+        self._command = command
+        self._body = body
+        self.timestamp = timestamp
+        self.stream_id = stream_id
+
+    command = lazy_field('command')
+
+    def decode_body(self):
+        self._command = decode_amf_values(self._body)
+        self._body = None
+
+class DataMessage(LazyMessage):
+    """ An AMF0 data message, e.g. stream metadata. """
+
+    __slots__ = ('_data', '_body', 'timestamp', 'stream_id')
+    datatype = DataTypes.DATA
+    fields = ('data', 'timestamp', 'stream_id')
+
+    def __init__(self, data=None, timestamp=0, stream_id=0, body=None):
+        self._data = data
+        self._body = body
+        self.timestamp = timestamp
+        self.stream_id = stream_id
+
+    data = lazy_field('data')
+
+    def decode_body(self):
+        self._data = decode_amf_values(self._body)
+        self._body = None
+
+class SharedObjectMessage(LazyMessage):
+    """
+    A shared object message carrying a number of events. A received message
+    has its name, version and flags decoded right away (they are needed for
+    routing) and its events only when they are first accessed.
+    """
+
+    __slots__ = ('_obj_name', '_curr_version', '_flags', '_events', '_body',
+        'timestamp', 'stream_id')
+    datatype = DataTypes.SHARED_OBJECT
+    fields = ('obj_name', 'curr_version', 'flags', 'events', 'timestamp',
+        'stream_id')
+
+    def __init__(self, obj_name, curr_version=0,
+                 flags='\x00\x00\x00\x00\x00\x00\x00\x00', events=None,
+                 timestamp=0, stream_id=0, body=None):
+        self._obj_name = obj_name
+        self._curr_version = curr_version
+        self._flags = flags
+        self._events = events
+        self._body = body
+        self.timestamp = timestamp
+        self.stream_id = stream_id
+
+    obj_name = stored_field('obj_name')
+    curr_version = stored_field('curr_version')
+    flags = stored_field('flags')
+    events = lazy_field('events')
+
+    def decode_body(self):
+        """
+        Decode the events. They follow the name, version and flags that have
+        already been decoded.
+        """
+        start = struct.unpack_from('!H', self._body)[0] + 14
+        try:
+            decoder = rtmp_amf0.Decoder(self._body, start)
+            events = read_shared_object_events(decoder, decoder)
+        except rtmp_amf0.UnsupportedType:
+            body_stream = MemoryViewDataTypeMixIn(self._body)
+            body_stream.seek(start)
+            events = read_shared_object_events(body_stream,
+                pyamf.amf0.Decoder(body_stream))
+
+        self._events = events
+        self._body = None
+
+class SOEvent(Record):
+    """ An event inside a shared object message. """
+
+    __slots__ = ('type', 'data')
+    fields = ('type', 'data')
+
+    def __init__(self, type, data=''):
+        self.type = type
+        self.data = data
+
+MESSAGE_CLASSES = {
+    DataTypes.SET_CHUNK_SIZE: SetChunkSizeMessage,
+    DataTypes.ACKNOWLEDGEMENT: AcknowledgementMessage,
+    DataTypes.USER_CONTROL: UserControlMessage,
+    DataTypes.WINDOW_ACK_SIZE: WindowAckSizeMessage,
+    DataTypes.SET_PEER_BANDWIDTH: SetPeerBandwidthMessage,
+    DataTypes.AUDIO: AudioMessage,
+    DataTypes.VIDEO: VideoMessage,
+    DataTypes.DATA: DataMessage,
+    DataTypes.SHARED_OBJECT: SharedObjectMessage,
+    DataTypes.COMMAND: CommandMessage,
+}
+
+def message_from_dict(message):
+    """
+    Create a message object from the dict form of a message, e.g.
+    {'msg': DataTypes.COMMAND, 'command': [...]}.
+    """
+    kwargs = {}
+    for key in message:
+        if key != 'msg':
+            kwargs[key] = message[key]
+    if 'events' in kwargs:
+        kwargs['events'] = [SOEvent(event['type'], event.get('data', ''))
+            for event in kwargs['events']]
+    return MESSAGE_CLASSES[message['msg']](**kwargs)
+
+def decode_amf_values(body):
+    """
+    Decode all the AMF0 values found in the body of a message. pyamf is only
+    used for the types that rtmp_amf0 does not support.
+    """
+    try:
+        return rtmp_amf0.decode(body)
+    except rtmp_amf0.UnsupportedType:
+        pass
+    body_stream = MemoryViewDataTypeMixIn(body)
+    decoder = pyamf.amf0.Decoder(body_stream)
+    values = []
+    while not body_stream.at_eof():
+        values.append(decoder.readElement())
+    return values
+
+def encode_amf_values(values):
+    """
+    Encode AMF0 values back to back. pyamf is only used for the types that
+    rtmp_amf0 does not support.
+    """
+    try:
+        return rtmp_amf0.encode(*values)
+    except rtmp_amf0.UnsupportedType:
+        pass
+    body_stream = pyamf.util.BufferedByteStream()
+    encoder = pyamf.amf0.Encoder(body_stream)
+    for value in values:
+        encoder.writeElement(value)
+    return body_stream.getvalue()
+
+def encode_amf_attributes(attrs):
+    """
+    Encode the names and values of a dict, as found in the shared object
+    change events.
+    """
+    try:
+        encoder = rtmp_amf0.Encoder()
+        for attrib_name in attrs:
+            encoder.write_string(attrib_name)
+            encoder.write_element(attrs[attrib_name])
+        return encoder.getvalue()
+    except rtmp_amf0.UnsupportedType:
+        pass
+    body_stream = pyamf.util.BufferedByteStream()
+    encoder = pyamf.amf0.Encoder(body_stream)
+    for attrib_name in attrs:
+        encoder.serialiseString(attrib_name)
+        encoder.writeElement(attrs[attrib_name])
+    return body_stream.getvalue()
+
+def read_shared_object_events(body_stream, decoder):
+    """
+    Read all the shared object events that follow in the body of a shared
+    object RTMP message.
+    """
+    events = []
+    while not body_stream.at_eof():
+        events.append(read_shared_object_event(body_stream, decoder))
+    return events
+
+def read_shared_object_event(body_stream, decoder):
+    """
+    Helper function that reads one shared object event found inside a shared
+    object RTMP message.
+    """
+    so_body_type = body_stream.read_uchar()
+    so_body_size = body_stream.read_ulong()
+
+    event = SOEvent(so_body_type)
+    if event.type == SOEventTypes.USE:
+        assert so_body_size == 0, so_body_size
+    elif event.type == SOEventTypes.RELEASE:
+        assert so_body_size == 0, so_body_size
+    elif event.type == SOEventTypes.CHANGE:
+        start_pos = body_stream.tell()
+        changes = {}
+        while body_stream.tell() < start_pos + so_body_size:
+            attrib_name = decoder.readString()
+            attrib_value = decoder.readElement()
+            assert attrib_name not in changes, (attrib_name,changes.keys())
+            changes[attrib_name] = attrib_value
+        assert body_stream.tell() == start_pos + so_body_size,\
+            (body_stream.tell(),start_pos,so_body_size)
+        event.data = changes
+    elif event.type == SOEventTypes.MESSAGE:
+        start_pos = body_stream.tell()
+        msg_params = []
+        while body_stream.tell() < start_pos + so_body_size:
+            msg_params.append(decoder.readElement())
+        assert body_stream.tell() == start_pos + so_body_size,\
+            (body_stream.tell(),start_pos,so_body_size)
+        event.data = msg_params
+    elif event.type == SOEventTypes.CLEAR:
+        assert so_body_size == 0, so_body_size
+    elif event.type == SOEventTypes.DELETE:
+        event.data = decoder.readString()
+    elif event.type == SOEventTypes.USE_SUCCESS:
+        assert so_body_size == 0, so_body_size
+    else:
+        assert False, event.type
+
+    return event
+
+def encode_message_body(message):
+    """
+    Return the encoded body of a message. Media bodies are opaque and are
+    returned as they are, so are the bodies of received messages that have
+    never been decoded.
+    """
+    body = message.raw_body()
+    if body is not None:
+        return body
+
+    datatype = message.datatype
+    body_stream = pyamf.util.BufferedByteStream()
+
+    if datatype == DataTypes.USER_CONTROL:
+        body_stream.write_ushort(message.event_type)
+        body_stream.write(message.event_data)
+    elif datatype == DataTypes.WINDOW_ACK_SIZE:
+        body_stream.write_ulong(message.window_ack_size)
+    elif datatype == DataTypes.SET_PEER_BANDWIDTH:
+        body_stream.write_ulong(message.window_ack_size)
+        body_stream.write_uchar(message.limit_type)
+    elif datatype == DataTypes.SET_CHUNK_SIZE:
+        body_stream.write_ulong(message.chunk_size)
+    elif datatype == DataTypes.ACKNOWLEDGEMENT:
+        body_stream.write_ulong(message.sequence_number)
+    elif datatype == DataTypes.COMMAND:
+        body_stream.write(encode_amf_values(message.command))
+    elif datatype == DataTypes.DATA:
+        body_stream.write(encode_amf_values(message.data))
+    elif datatype == DataTypes.SHARED_OBJECT:
+        body_stream.write(rtmp_amf0.encode_string(message.obj_name))
+        body_stream.write_ulong(message.curr_version)
+        body_stream.write(message.flags)
+
+        for event in message.events:
+            write_shared_object_event(event, body_stream)
+    else:
+        assert False, message
+
+    return body_stream.getvalue()
+
+def write_shared_object_event(event, body_stream):
+    """
+    Helper function that writes one shared object event inside a shared
+    object RTMP message.
+    """
+    inner = ''
+    event_type = event.type
+    if event_type == SOEventTypes.USE:
+        assert event.data == '', event.data
+    elif event_type == SOEventTypes.RELEASE:
+        assert event.data == '', event.data
+    elif event_type == SOEventTypes.CHANGE:
+        inner = encode_amf_attributes(event.data)
+    elif event_type == SOEventTypes.MESSAGE:
+        inner = encode_amf_values(event.data)
+    elif event_type == SOEventTypes.DELETE:
+        inner = rtmp_amf0.encode_string(event.data)
+    elif event_type == SOEventTypes.CLEAR:
+        assert event.data == '', event.data
+    elif event_type == SOEventTypes.USE_SUCCESS:
+        assert event.data == '', event.data
+    else:
+        assert False, event
+
+    body_stream.write_uchar(event_type)
+    body_stream.write_ulong(len(inner))
+    body_stream.write(inner)
+
+def default_channel_id(datatype):
+    """ Return the chunk stream id that messages of a datatype are sent on. """
+    # Values that just work. :-)
+    if datatype >= 1 and datatype <= 7:
+        return 2
+    elif datatype == DataTypes.AUDIO:
+        return 4
+    elif datatype == DataTypes.VIDEO:
+        return 6
+    else:
+        return 3
+
+class ChunkStream:
+    """
+    Holds the receiving state of one chunk stream: the last header seen on it
+    (needed to expand compressed type 1/2/3 headers) and the body of the
+    message that is currently being reassembled. The body is reassembled in
+    place into a bytearray preallocated from the message length.
+    """
+
+    def __init__(self, channel_id):
+        """ Initialize an empty chunk stream with the given id. """
+        self.channel_id = channel_id
+        self.header = None
+        self.delta = 0
+        self.extended = False
+        self.body = None
+        self.view = None
+        self.body_len = 0
+
+    def update(self, header):
+        """
+        Expand a (possibly compressed) chunk header that arrived on this chunk
+        stream using the previous header of the same stream. A new message is
+        started if no message is currently being reassembled. Returns the
+        complete header of the message that the chunk belongs to.
+        """
+        prv_header = self.header
+
+        if self.body is not None:
+            # Continuation chunk of the message that is being reassembled.
+            assert header.streamId == -1, (prv_header, header)
+            assert header.datatype == -1, (prv_header, header)
+            assert header.timestamp == -1, (prv_header, header)
+            assert header.bodyLength == -1, (prv_header, header)
+            return prv_header
+
+        if header.full:
+            # A type 3 header that starts a new message after a full header
+            # uses the timestamp of the full header as its delta.
+            self.delta = header.timestamp
+            timestamp = header.timestamp
+        else:
+            assert prv_header is not None, header
+            header.streamId = prv_header.streamId
+            if header.timestamp != -1:
+                self.delta = header.timestamp
+            timestamp = prv_header.timestamp + self.delta
+            if header.bodyLength == -1:
+                header.bodyLength = prv_header.bodyLength
+                header.datatype = prv_header.datatype
+
+        if header.timestamp != -1:
+            self.extended = header.timestamp >= 0x00ffffff
+        header.timestamp = timestamp
+        self.header = header
+        self.body = bytearray(header.bodyLength)
+        self.view = memoryview(self.body)
+        self.body_len = 0
+        return header
+
+    def read_chunk(self, stream, chunk_size):
+        """
+        Read the payload of one chunk from the stream directly into the body
+        of the current message. Returns the complete message body (a
+        bytearray) once all of its chunks have arrived, otherwise None.
+        """
+        start = self.body_len
+        self.body_len = min(self.header.bodyLength, start + chunk_size)
+        stream.readinto(self.view[start:self.body_len])
+        if self.body_len < self.header.bodyLength:
+            return None
+        body = self.body
+        self.body = self.view = None
+        return body
+
 class RtmpReader:
-    """ This class reads RTMP messages from a stream. """
+    """
+    This class reads RTMP messages from a stream. Chunks of different chunk
+    streams may be interleaved; messages are returned in the order they
+    complete.
+
+    If a metrics collector is attached (see rtmp_metrics), it is called for
+    every chunk and message that is read.
+    """
 
     chunk_size = 128
+    metrics = None
 
     def __init__(self, stream):
         """
         Initialize the RTMP reader and set it to read from the specified stream.
         """
         self.stream = stream
+        self.chunk_streams = {}
 
     def __iter__(self):
         return self
@@ -80,129 +820,133 @@ class RtmpReader:
         if self.stream.at_eof():
             raise StopIteration
 
-        # Read the message into body_stream. The message may span a number of
-        # chunks (each one with its own header).
-        message_body = []
-        msg_body_len = 0
-        header = rtmp_protocol_base.header_decode(self.stream)
-        # FIXME: this should be really implemented inside header_decode
-        if header.datatype == DataTypes.NONE:
-            header = self.prv_header
-        self.prv_header = header
+        # Read chunks until one of the chunk streams completes a message.
         while True:
-            read_bytes = min(header.bodyLength - msg_body_len, self.chunk_size)
-            message_body.append(self.stream.read(read_bytes))
-            msg_body_len += read_bytes
-            if msg_body_len >= header.bodyLength:
-                break
-            next_header = rtmp_protocol_base.header_decode(self.stream)
-            # WORKAROUND: even though the RTMP specification states that the
-            # extended timestamp field DOES NOT follow type 3 chunks, it seems
-            # that Flash player 10.1.85.3 and Flash Media Server 3.0.2.217 send
-            # and expect this field here.
-            if header.timestamp >= 0x00ffffff:
-                self.stream.read_ulong()
-            assert next_header.streamId == -1, (header, next_header)
-            assert next_header.datatype == -1, (header, next_header)
-            assert next_header.timestamp == -1, (header, next_header)
-            assert next_header.bodyLength == -1, (header, next_header)
-        assert header.bodyLength == msg_body_len, (header, msg_body_len)
-        body_stream = pyamf.util.BufferedByteStream(''.join(message_body))
+            header = rtmp_protocol_base.header_decode(self.stream)
+            message = self.read_chunk(header)
+            if message is not None:
+                return message
 
+    def chunk_length(self, header):
+        """
+        Return the number of bytes that follow the given (just decoded) chunk
+        header on the wire. The state of the reader is not modified.
+        """
+        chunk_stream = self.chunk_streams.get(header.channelId)
+        if chunk_stream is not None and chunk_stream.body is not None:
+            length = min(chunk_stream.header.bodyLength -
+                chunk_stream.body_len, self.chunk_size)
+        elif header.bodyLength == -1:
+            assert chunk_stream is not None, header
+            length = min(chunk_stream.header.bodyLength, self.chunk_size)
+        else:
+            return min(header.bodyLength, self.chunk_size)
+        # See the extended timestamp workaround in read_chunk.
+        if header.timestamp == -1 and chunk_stream.extended:
+            length += 4
+        return length
+
+    def read_chunk(self, header):
+        """
+        Read the rest of the chunk whose header has just been decoded. Returns
+        the decoded message if the chunk completed one, otherwise None.
+        """
+        chunk_stream = self.chunk_streams.get(header.channelId)
+        if chunk_stream is None:
+            chunk_stream = ChunkStream(header.channelId)
+            self.chunk_streams[header.channelId] = chunk_stream
+        # Only a type 3 header has no timestamp field.
+        type3 = header.timestamp == -1
+        header = chunk_stream.update(header)
+        # WORKAROUND: even though the RTMP specification states that the
+        # extended timestamp field DOES NOT follow type 3 chunks, it seems
+        # that Flash player 10.1.85.3 and Flash Media Server 3.0.2.217 send
+        # and expect this field here. It follows every type 3 header of a
+        # chunk stream whose last timestamp field was extended, whether the
+        # chunk continues a message or starts a new one.
+        if type3 and chunk_stream.extended:
+            self.stream.read_ulong()
+        body = chunk_stream.read_chunk(self.stream, self.chunk_size)
+        if self.metrics is not None:
+            self.metrics.chunk_received()
+        if body is None:
+            return None
+        return self.decode_message(header, body)
+
+    def decode_message(self, header, body):
+        """
+        Decode the body of a complete message based on its header. Fixed-size
+        control messages are unpacked straight from the body buffer; AMF
+        payloads are decoded lazily from a memoryview over it.
+        """
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.time()
         # Decode the message based on the datatype present in the header
-        ret = {'msg':header.datatype}
-        if ret['msg'] == DataTypes.USER_CONTROL:
-            ret['event_type'] = body_stream.read_ushort()
-            ret['event_data'] = body_stream.read()
-        elif ret['msg'] == DataTypes.WINDOW_ACK_SIZE:
-            ret['window_ack_size'] = body_stream.read_ulong()
-        elif ret['msg'] == DataTypes.SET_PEER_BANDWIDTH:
-            ret['window_ack_size'] = body_stream.read_ulong()
-            ret['limit_type'] = body_stream.read_uchar()
-        elif ret['msg'] == DataTypes.SHARED_OBJECT:
-            decoder = pyamf.amf0.Decoder(body_stream)
-            obj_name = decoder.readString()
-            curr_version = body_stream.read_ulong()
-            flags = body_stream.read(8)
-
-            # A shared object message may contain a number of events.
-            events = []
-            while not body_stream.at_eof():
-                event = self.read_shared_object_event(body_stream, decoder)
-                events.append(event)
-
-            ret['obj_name'] = obj_name
-            ret['curr_version'] = curr_version
-            ret['flags'] = flags
-            ret['events'] = events
-        elif ret['msg'] == DataTypes.COMMAND:
-            decoder = pyamf.amf0.Decoder(body_stream)
-            commands = []
-            while not body_stream.at_eof():
-                commands.append(decoder.readElement())
-            ret['command'] = commands
-        #elif ret['msg'] == DataTypes.NONE:
+        datatype = header.datatype
+        if datatype == DataTypes.USER_CONTROL:
+            ret = UserControlMessage(struct.unpack_from('!H', body)[0],
+                bytes(body[2:]))
+        elif datatype == DataTypes.WINDOW_ACK_SIZE:
+            ret = WindowAckSizeMessage(struct.unpack_from('!L', body)[0])
+        elif datatype == DataTypes.SET_PEER_BANDWIDTH:
+            ret = SetPeerBandwidthMessage(*struct.unpack_from('!LB', body))
+        elif datatype == DataTypes.SHARED_OBJECT:
+            # The name, version and flags are needed for routing and are
+            # decoded right away, the events only when first accessed.
+            name_len = struct.unpack_from('!H', body)[0]
+            ret = SharedObjectMessage(
+                bytes(body[2:2 + name_len]).decode('utf-8'),
+                struct.unpack_from('!L', body, 2 + name_len)[0],
+                bytes(body[6 + name_len:14 + name_len]),
+                timestamp=header.timestamp, stream_id=header.streamId,
+                body=body)
+        elif datatype == DataTypes.COMMAND:
+            ret = CommandMessage(timestamp=header.timestamp,
+                stream_id=header.streamId, body=body)
+        elif datatype == DataTypes.DATA:
+            ret = DataMessage(timestamp=header.timestamp,
+                stream_id=header.streamId, body=body)
+        elif datatype == DataTypes.AUDIO:
+            # Media is passed through as the opaque reassembly buffer.
+            ret = AudioMessage(body, header.timestamp, header.streamId)
+        elif datatype == DataTypes.VIDEO:
+            ret = VideoMessage(body, header.timestamp, header.streamId)
+        elif datatype == DataTypes.ACKNOWLEDGEMENT:
+            ret = AcknowledgementMessage(struct.unpack_from('!L', body)[0])
+        #elif datatype == DataTypes.NONE:
         #    print 'WARNING: message with no datatype received.', header
         #    return self.next()
-        elif ret['msg'] == DataTypes.SET_CHUNK_SIZE:
-            ret['chunk_size'] = body_stream.read_ulong()
+        elif datatype == DataTypes.SET_CHUNK_SIZE:
+            ret = SetChunkSizeMessage(struct.unpack_from('!L', body)[0])
         else:
             assert False, header
 
-        logging.debug('recv %r', ret)
+        if metrics is not None:
+            metrics.message_received(datatype, len(body), time.time() - start)
+        # Formatting a message decodes it, only do it if it is logged.
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('recv %r', ret)
         return ret
 
-    def read_shared_object_event(self, body_stream, decoder):
-        """
-        Helper method that reads one shared object event found inside a shared
-        object RTMP message.
-        """
-        so_body_type = body_stream.read_uchar()
-        so_body_size = body_stream.read_ulong()
-
-        event = {'type':so_body_type}
-        if event['type'] == SOEventTypes.USE:
-            assert so_body_size == 0, so_body_size
-            event['data'] = ''
-        elif event['type'] == SOEventTypes.RELEASE:
-            assert so_body_size == 0, so_body_size
-            event['data'] = ''
-        elif event['type'] == SOEventTypes.CHANGE:
-            start_pos = body_stream.tell()
-            changes = {}
-            while body_stream.tell() < start_pos + so_body_size:
-                attrib_name = decoder.readString()
-                attrib_value = decoder.readElement()
-                assert attrib_name not in changes, (attrib_name,changes.keys())
-                changes[attrib_name] = attrib_value
-            assert body_stream.tell() == start_pos + so_body_size,\
-                (body_stream.tell(),start_pos,so_body_size)
-            event['data'] = changes
-        elif event['type'] == SOEventTypes.MESSAGE:
-            start_pos = body_stream.tell()
-            msg_params = []
-            while body_stream.tell() < start_pos + so_body_size:
-                msg_params.append(decoder.readElement())
-            assert body_stream.tell() == start_pos + so_body_size,\
-                (body_stream.tell(),start_pos,so_body_size)
-            event['data'] = msg_params
-        elif event['type'] == SOEventTypes.CLEAR:
-            assert so_body_size == 0, so_body_size
-            event['data'] = ''
-        elif event['type'] == SOEventTypes.DELETE:
-            event['data'] = decoder.readString()
-        elif event['type'] == SOEventTypes.USE_SUCCESS:
-            assert so_body_size == 0, so_body_size
-            event['data'] = ''
-        else:
-            assert False, event['type']
+class RtmpWriter:
+    """
+    This class writes RTMP messages into a stream. The last header sent on
+    each chunk stream is remembered so that following messages can be sent
+    with compressed (type 1, 2 or 3) headers.
 
-        return event
+    If adaptive_chunk_size is set, the outbound chunk size is periodically
+    adjusted to the sizes of the messages that are being sent.
 
-class RtmpWriter:
-    """ This class writes RTMP messages into a stream. """
+    If a metrics collector is attached (see rtmp_metrics), it is called for
+    every message that is encoded and written.
+    """
 
     chunk_size = 128
+    metrics = None
+    adaptive_chunk_size = False
+    max_chunk_size = 65536
+    adapt_interval = 64
 
     def __init__(self, stream):
         """
@@ -210,105 +954,472 @@ class RtmpWriter:
         stream.
         """
         self.stream = stream
+        self.prv_headers = {}
+        self.message_sizes = []
+        # Room for a full header followed by a continuation header.
+        self.header_buffer = bytearray(32)
+        self.header_view = memoryview(self.header_buffer)
+
+    def set_chunk_size(self, chunk_size):
+        """
+        Announce a new outbound chunk size to the peer and use it for all the
+        following messages.
+        """
+        if chunk_size == self.chunk_size:
+            return
+        self.write(SetChunkSizeMessage(chunk_size))
+        self.chunk_size = chunk_size
+
+    def adapt_chunk_size(self, body_len):
+        """
+        Record the size of a message that is about to be sent. Every
+        adapt_interval messages the chunk size is set to the smallest power of
+        two (at least 128 and at most max_chunk_size) that sends 90% of the
+        recent messages in a single chunk.
+        """
+        self.message_sizes.append(body_len)
+        if len(self.message_sizes) < self.adapt_interval:
+            return
+        sizes = sorted(self.message_sizes)
+        self.message_sizes = []
+        target = sizes[len(sizes) * 9 // 10]
+        chunk_size = 128
+        while chunk_size < target and chunk_size < self.max_chunk_size:
+            chunk_size *= 2
+        self.set_chunk_size(chunk_size)
 
     def flush(self):
         """ Flush the underlying stream. """
         self.stream.flush()
 
-    def write(self, message):
-        logging.debug('send %r', message)
-        """ Encode and write the specified message into the stream. """
-        datatype = message['msg']
-        body_stream = pyamf.util.BufferedByteStream()
-        encoder = pyamf.amf0.Encoder(body_stream)
+    def write(self, message, timestamp=None, channel_id=None, stream_id=None):
+        """
+        Encode and write the specified message into the stream. The message is
+        a Message object, its dict form or a PreparedMessage. The timestamp,
+        chunk stream id and message stream id are passed on to send_msg; the
+        timestamp and message stream id default to those of the message, if
+        any, otherwise to 0.
+        """
+        if isinstance(message, PreparedMessage):
+            assert timestamp is None and stream_id is None, message
+            self.send_prepared(message, channel_id)
+            return
+        if isinstance(message, dict):
+            message = message_from_dict(message)
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('send %r', message)
+        datatype = message.datatype
+        if timestamp is None:
+            timestamp = getattr(message, 'timestamp', 0)
+        if stream_id is None:
+            stream_id = getattr(message, 'stream_id', 0)
+
+        metrics = self.metrics
+        if metrics is None:
+            body = encode_message_body(message)
+        else:
+            start = time.time()
+            body = encode_message_body(message)
+            metrics.message_encoded(time.time() - start)
+        self.send_msg(datatype, body, timestamp, channel_id, stream_id)
 
-        if datatype == DataTypes.USER_CONTROL:
-            body_stream.write_ushort(message['event_type'])
-            body_stream.write(message['event_data'])
-        elif datatype == DataTypes.WINDOW_ACK_SIZE:
-            body_stream.write_ulong(message['window_ack_size'])
-        elif datatype == DataTypes.SET_PEER_BANDWIDTH:
-            body_stream.write_ulong(message['window_ack_size'])
-            body_stream.write_uchar(message['limit_type'])
-        elif datatype == DataTypes.COMMAND:
-            for command in message['command']:
-                encoder.writeElement(command)
-        elif datatype == DataTypes.SHARED_OBJECT:
-            encoder.serialiseString(message['obj_name'])
-            body_stream.write_ulong(message['curr_version'])
-            body_stream.write(message['flags'])
+    def send_prepared(self, prepared, channel_id=None):
+        """
+        Write a PreparedMessage into the stream. Its cached wire form is
+        written as it is. If channel_id is None, the chunk stream of the
+        prepared message is used.
+        """
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('send %r', prepared)
+        if channel_id is None:
+            channel_id = prepared.channel_id
+        if self.adaptive_chunk_size and \
+                prepared.datatype != DataTypes.SET_CHUNK_SIZE:
+            self.adapt_chunk_size(len(prepared.body))
+        self.stream.write(prepared.chunked(self.chunk_size, channel_id))
+        self.full_header_sent(channel_id, prepared.datatype,
+            len(prepared.body), prepared.timestamp, prepared.stream_id)
+        if self.metrics is not None:
+            self.metrics.message_sent(prepared.datatype, len(prepared.body),
+                self.chunk_count(len(prepared.body)))
+
+    def chunk_count(self, body_len):
+        """ Return the number of chunks that a message body is split into. """
+        return max(1, (body_len + self.chunk_size - 1) // self.chunk_size)
+
+    def full_header_sent(self, channel_id, datatype, body_len, timestamp,
+                         stream_id):
+        """
+        Remember that a message was sent with a full header on a chunk stream.
+        The next header on the chunk stream sends its timestamp as a delta.
+        The peer takes the absolute timestamp of a full header as the delta of
+        a following type 3 header, so it is remembered as the previous delta.
+        Returns whether the timestamp was extended.
+        """
+        extended = timestamp >= 0xffffff
+        self.prv_headers[channel_id] = (rtmp_protocol_base.Header(
+            channelId=channel_id,
+            streamId=stream_id,
+            datatype=datatype,
+            bodyLength=body_len,
+            timestamp=timestamp), timestamp, extended)
+        return extended
 
-            for event in message['events']:
-                self.write_shared_object_event(event, body_stream)
-        else:
-            assert False, message
+    def send_msg(self, datatype, body, timestamp=0, channel_id=None,
+                 stream_id=0):
+        """
+        Helper method that send the specified message into the stream. Takes
+        care to prepend the necessary headers and split the message into
+        appropriately sized chunks.
 
-        self.send_msg(datatype, body_stream.getvalue())
+        The header is compressed against the previous message of the same
+        chunk stream: the timestamp is sent as a delta and fields that did not
+        change are omitted. If channel_id is None, a chunk stream is chosen
+        based on the datatype.
+        """
+        if channel_id is None:
+            channel_id = default_channel_id(datatype)
+
+        if self.adaptive_chunk_size and datatype != DataTypes.SET_CHUNK_SIZE:
+            self.adapt_chunk_size(len(body))
+
+        # The previous header holds the timestamp delta that the peer assumes
+        # for a type 3 header, min_bytes_required compares it with ours. Like
+        # in RtmpReader, the extended timestamp workaround applies if the last
+        # timestamp field sent on the chunk stream was extended.
+        prv_header, prv_timestamp, extended = self.prv_headers.get(channel_id,
+            (None, 0, False))
+        delta = timestamp - prv_timestamp
+        header_buffer = self.header_buffer
+
+        if prv_header is None or prv_header.streamId != stream_id or \
+                delta < 0 or delta >= 0xffffff:
+            header = rtmp_protocol_base.Header(
+                channelId=channel_id,
+                streamId=stream_id,
+                datatype=datatype,
+                bodyLength=len(body),
+                timestamp=timestamp)
+            end = rtmp_protocol_base.header_encode_into(header_buffer, 0,
+                header)
+            extended = self.full_header_sent(channel_id, datatype, len(body),
+                timestamp, stream_id)
+        else:
+            header = rtmp_protocol_base.Header(
+                channelId=channel_id,
+                streamId=stream_id,
+                datatype=datatype,
+                bodyLength=len(body),
+                timestamp=delta)
+            type3 = rtmp_protocol_base.min_bytes_required(header,
+                prv_header) == 0xc0
+            if not type3:
+                extended = False
+            end = rtmp_protocol_base.header_encode_into(header_buffer, 0,
+                header, prv_header)
+            # See the extended timestamp workaround in RtmpReader. The field
+            # repeats the last extended timestamp field of the chunk stream.
+            if type3 and extended:
+                struct.pack_into('!L', header_buffer, end, delta)
+                end += 4
+            self.prv_headers[channel_id] = (header, timestamp, extended)
+
+        # The message goes out as a list of header bytes and memoryview
+        # slices of the body, written with a single call. The headers are
+        # encoded into a buffer that is reused for every message. The type 3
+        # continuation header is the same for every chunk and is encoded once,
+        # right after the first header.
+        header_view = self.header_view
+        pieces = [header_view[:end]]
+        if len(body) > self.chunk_size:
+            continuation_end = rtmp_protocol_base.header_encode_into(
+                header_buffer, end, header, header)
+            # See the extended timestamp workaround in RtmpReader.
+            if extended:
+                struct.pack_into('!L', header_buffer, continuation_end,
+                    header.timestamp)
+                continuation_end += 4
+            continuation = header_view[end:continuation_end]
+        view = memoryview(body)
+        for i in xrange(0,len(body),self.chunk_size):
+            if i:
+                pieces.append(continuation)
+            pieces.append(view[i:i+self.chunk_size])
+        self.stream.writev(pieces)
+        if self.metrics is not None:
+            self.metrics.message_sent(datatype, len(body),
+                self.chunk_count(len(body)))
+
+class PreparedMessage:
+    """
+    A message that is encoded once and can then be sent to any number of
+    connections, e.g. a reply that never changes or a shared object update
+    that is broadcast to its subscribers. The chunked wire form of the message
+    (with a full header) is built once per chunk size and chunk stream and the
+    same bytes are written by every RtmpWriter.
+    """
 
-    def write_shared_object_event(self, event, body_stream):
+    def __init__(self, message, timestamp=None, channel_id=None,
+                 stream_id=None):
         """
-        Helper method that writes one shared object inside a shared object RTMP
-        message.
+        Encode a Message object (or its dict form). The timestamp and message
+        stream id default to those of the message, if any, otherwise to 0. The
+        chunk stream id defaults to the one chosen by RtmpWriter.
         """
+        if isinstance(message, dict):
+            message = message_from_dict(message)
+        self.message = message
+        self.datatype = message.datatype
+        if timestamp is None:
+            timestamp = getattr(message, 'timestamp', 0)
+        if stream_id is None:
+            stream_id = getattr(message, 'stream_id', 0)
+        if channel_id is None:
+            channel_id = default_channel_id(self.datatype)
+        self.timestamp = timestamp
+        self.stream_id = stream_id
+        self.channel_id = channel_id
+        body = encode_message_body(message)
+        if isinstance(body, memoryview):
+            body = body.tobytes()
+        self.body = bytes(body)
+        self.wire = {}
+
+    def __repr__(self):
+        return '<PreparedMessage %r>' % (self.message,)
+
+    def chunked(self, chunk_size, channel_id):
+        """
+        Return the bytes of the message on the wire for a chunk size and
+        chunk stream.
+        """
+        wire = self.wire.get((chunk_size, channel_id))
+        if wire is None:
+            writer = RtmpWriter(FileDataTypeMixIn(io.BytesIO()))
+            writer.chunk_size = chunk_size
+            writer.send_msg(self.datatype, self.body, self.timestamp,
+                channel_id, self.stream_id)
+            wire = writer.stream.fileobject.getvalue()
+            self.wire[(chunk_size, channel_id)] = wire
+        return wire
+
+class RtmpConnectionState:
+    """
+    A push based (sans-IO) RTMP protocol engine. It performs no I/O itself:
+    bytes received from the peer are passed to feed(), which returns the
+    messages they complete, and everything the engine wants to send is
+    collected in an internal buffer that is drained with data_to_send(). Input
+    may be split at any byte boundary, so any event loop, selector or test
+    harness can drive the protocol without blocking calls.
+
+    The engine counts the bytes it receives and sends. Received bytes are
+    acknowledged automatically every time the window announced by the peer
+    (with a window acknowledgement size message) is filled, and the
+    acknowledgements of the peer are tracked so that the owner of the engine
+    can stop sending to a peer that falls behind (see unacknowledged()).
+
+    A metrics collector can be attached with set_metrics().
+    """
 
-        inner_stream = pyamf.util.BufferedByteStream()
-        encoder = pyamf.amf0.Encoder(inner_stream)
+    WAITING_S0_S1 = 0
+    WAITING_S2 = 1
+    WAITING_C0_C1 = 2
+    WAITING_C2 = 3
+    ESTABLISHED = 4
 
-        event_type = event['type']
-        if event_type == SOEventTypes.USE:
-            assert event['data'] == '', event['data']
-        elif event_type == SOEventTypes.CHANGE:
-            for attrib_name in event['data']:
-                attrib_value = event['data'][attrib_name]
-                encoder.serialiseString(attrib_name)
-                encoder.writeElement(attrib_value)
-        elif event['type'] == SOEventTypes.CLEAR:
-            assert event['data'] == '', event['data']
-        elif event['type'] == SOEventTypes.USE_SUCCESS:
-            assert event['data'] == '', event['data']
+    def __init__(self, is_client):
+        """
+        Initialize the engine for the client or the server side of a
+        connection. A client immediately queues its C0 and C1 handshake
+        packets.
+        """
+        self.is_client = is_client
+        self.pending = ''
+        self.out_stream = FileDataTypeMixIn(io.BytesIO())
+        self.reader = RtmpReader(None)
+        self.writer = RtmpWriter(self.out_stream)
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        # Received bytes are acknowledged every ack_window bytes.
+        self.ack_window = None
+        self.last_ack = 0
+        # The window announced to the peer and the bytes it acknowledged.
+        self.window_ack_size = None
+        self.peer_acked = 0
+        self.metrics = None
+        self.handshake_start = time.time()
+
+        # The C1 or S1 packet, the peer has to echo it.
+        self.handshake_packet = rtmp_protocol_base.handshake_packet()
+        if is_client:
+            self.state = self.WAITING_S0_S1
+            self.out_stream.write('\x03' + self.handshake_packet)
         else:
-            assert False, event
+            self.state = self.WAITING_C0_C1
+
+    def feed(self, data):
+        """
+        Feed bytes received from the peer into the engine. Returns the list of
+        messages that were completed by them. Incomplete headers and chunks are
+        kept until more data arrives.
+        """
+        self.bytes_received += len(data)
+        if self.metrics is not None:
+            self.metrics.received(len(data))
+        if self.pending:
+            data = self.pending + data
+        stream = MemoryViewDataTypeMixIn(data)
+        self.reader.stream = stream
+        messages = []
+
+        while True:
+            start = stream.tell()
+            if self.state != self.ESTABLISHED:
+                if not self.handle_handshake(stream):
+                    break
+                continue
+            # Headers are decoded straight from the buffer.
+            result = rtmp_protocol_base.header_decode_from(data, start)
+            if result is None:
+                break
+            header, pos = result
+            if len(data) - pos < self.reader.chunk_length(header):
+                break
+            stream.seek(pos)
+            message = self.reader.read_chunk(header)
+            if message is None:
+                continue
+            self.handle_control_message(message)
+            messages.append(message)
+
+        self.reader.stream = None
+        self.pending = data[stream.tell():]
+
+        if self.ack_window and \
+                self.bytes_received - self.last_ack >= self.ack_window:
+            self.send(AcknowledgementMessage(self.bytes_received & 0xffffffff))
+            self.last_ack = self.bytes_received
 
-        body_stream.write_uchar(event_type)
-        body_stream.write_ulong(len(inner_stream))
-        body_stream.write(inner_stream.getvalue())
+        return messages
 
-    def send_msg(self, datatype, body):
+    def set_metrics(self, metrics):
         """
-        Helper method that send the specified message into the stream. Takes
-        care to prepend the necessary headers and split the message into
-        appropriately sized chunks.
+        Attach a metrics collector to the engine and its reader and writer
+        (None detaches it).
         """
+        self.metrics = metrics
+        self.reader.metrics = metrics
+        self.writer.metrics = metrics
 
-        # Values that just work. :-)
-        if datatype >= 1 and datatype <= 7:
-            channel_id = 2
-            stream_id = 0
-        else:
-            channel_id = 3
-            stream_id = 0
-        timestamp = 0
+    def handle_control_message(self, message):
+        """
+        Apply the protocol control messages that change the state of the
+        engine. They are returned by feed() like any other message.
+        """
+        datatype = message.datatype
+        if datatype == DataTypes.SET_CHUNK_SIZE:
+            # A new chunk size applies to the very next chunk, which may
+            # already be in this buffer.
+            self.reader.chunk_size = message.chunk_size
+        elif datatype == DataTypes.WINDOW_ACK_SIZE:
+            self.ack_window = message.window_ack_size
+        elif datatype == DataTypes.SET_PEER_BANDWIDTH:
+            # The peer limits the bytes that it has not acknowledged, so it
+            # has to acknowledge them in the same window.
+            if message.window_ack_size != self.window_ack_size:
+                self.set_window_ack_size(message.window_ack_size)
+        elif datatype == DataTypes.ACKNOWLEDGEMENT:
+            # The sequence number is the byte count of the peer modulo 2^32.
+            self.peer_acked = self.bytes_sent - \
+                ((self.bytes_sent - message.sequence_number) & 0xffffffff)
+
+    def set_window_ack_size(self, window_ack_size):
+        """
+        Announce to the peer that it has to acknowledge the bytes it receives
+        every window_ack_size bytes.
+        """
+        self.send(WindowAckSizeMessage(window_ack_size))
+        self.window_ack_size = window_ack_size
 
-        header = rtmp_protocol_base.Header(
-            channelId=channel_id,
-            streamId=stream_id,
-            datatype=datatype,
-            bodyLength=len(body),
-            timestamp=timestamp)
-        rtmp_protocol_base.header_encode(self.stream, header)
+    def unacknowledged(self):
+        """
+        Return the number of bytes returned by data_to_send() that the peer
+        has not acknowledged yet.
+        """
+        return self.bytes_sent - self.peer_acked
 
-        for i in xrange(0,len(body),self.chunk_size):
-            chunk = body[i:i+self.chunk_size]
-            self.stream.write(chunk)
-            if i+self.chunk_size < len(body):
-                rtmp_protocol_base.header_encode(self.stream, header, header)
+    def handle_handshake(self, stream):
+        """
+        Consume the next handshake packet(s) from the stream if they have fully
+        arrived and queue the reply. The server replies to C0 and C1 with S0,
+        S1 and S2 at once. The echo of our own packet (C2 or S2) is checked.
+        Returns False if more data is needed.
+        """
+        if self.state in (self.WAITING_S0_S1, self.WAITING_C0_C1):
+            if stream.remaining() < 1 + rtmp_protocol_base.HANDSHAKE_LENGTH:
+                return False
+            # Skip the version.
+            stream.seek(1, 1)
+        elif stream.remaining() < rtmp_protocol_base.HANDSHAKE_LENGTH:
+            return False
+        packet = stream.read(rtmp_protocol_base.HANDSHAKE_LENGTH)
+
+        if self.state == self.WAITING_S0_S1:
+            # C2 echoes S1.
+            self.out_stream.write(packet)
+            self.state = self.WAITING_S2
+        elif self.state == self.WAITING_C0_C1:
+            # S2 echoes C1.
+            self.out_stream.write('\x03' + self.handshake_packet + packet)
+            self.state = self.WAITING_C2
+        else:
+            rtmp_protocol_base.check_handshake_echo(self.handshake_packet,
+                packet)
+            self.state = self.ESTABLISHED
+            if self.metrics is not None:
+                self.metrics.handshake_completed(
+                    time.time() - self.handshake_start)
+        return True
+
+    def send(self, message):
+        """ Encode a message and queue it for sending. """
+        self.writer.write(message)
+
+    def data_to_send(self):
+        """ Return and clear the bytes that are queued for sending. """
+        fileobject = self.out_stream.fileobject
+        data = fileobject.getvalue()
+        fileobject.seek(0)
+        fileobject.truncate()
+        self.bytes_sent += len(data)
+        if self.metrics is not None:
+            self.metrics.sent(len(data))
+        return data
 
 class FlashSharedObject:
     """
     This class represents a Flash Remote Shared Object. Its data are located
     inside the self.data dictionary.
+
+    Local changes made with set() and delete() are buffered and sent together
+    in one message, once flush_size properties are pending or flush_interval
+    seconds after the first pending change (checked when the shared object is
+    changed and by the message loop of RtmpClient), or when flush() is called.
+    The first pending change calls wakeup, if set, so that the message loop
+    starts waiting for it to become due.
+    Repeated changes of a property are sent only once. Changes made before
+    the SO is in use are kept until the server confirms the use, they are
+    then applied over the data received from the server and sent.
+
+    set(), delete() and flush() may be called from any thread: they hold the
+    lock of the SO, which RtmpClient.shared_object_use replaces with the lock
+    that the client holds while it handles messages and writes.
     """
 
+    flush_interval = 0.1
+    flush_size = 100
+    wakeup = None
+
     def __init__(self, name):
         """
         Initialize a new Flash Remote SO with a given name and empty data.
@@ -316,6 +1427,11 @@ class FlashSharedObject:
         self.name = name
         self.data = {}
         self.use_success = False
+        self.writer = None
+        self.pending_changes = {}
+        self.pending_deletes = set()
+        self.pending_since = None
+        self.lock = threading.RLock()
 
     def use(self, reader, writer):
         """
@@ -323,60 +1439,138 @@ class FlashSharedObject:
         remote changes to the SO should be now propagated to the client.
         """
         self.use_success = False
+        self.writer = writer
 
-        msg = {
-            'msg': DataTypes.SHARED_OBJECT,
-            'curr_version': 0,
-            'flags': '\x00\x00\x00\x00\x00\x00\x00\x00',
-            'events': [
-                {
-                    'data': '',
-                    'type': SOEventTypes.USE
-                }
-            ],
-            'obj_name': self.name
-        }
+        msg = SharedObjectMessage(self.name, events=[SOEvent(SOEventTypes.USE)])
         writer.write(msg)
         writer.flush()
 
+    def set(self, key, value):
+        """ Set a property of the SO and buffer the change. """
+        with self.lock:
+            self.data[key] = value
+            self.pending_changes[key] = value
+            self.pending_deletes.discard(key)
+            self.change_buffered()
+
+    def delete(self, key):
+        """ Delete a property of the SO and buffer the change. """
+        with self.lock:
+            del self.data[key]
+            self.pending_changes.pop(key, None)
+            self.pending_deletes.add(key)
+            self.change_buffered()
+
+    def change_buffered(self):
+        """ Flush the buffered changes if there are enough of them. """
+        if self.pending_since is None:
+            self.pending_since = time.time()
+            if self.wakeup is not None:
+                self.wakeup()
+        if len(self.pending_changes) + len(self.pending_deletes) >= \
+                self.flush_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """ Flush the buffered changes if the flush interval has elapsed. """
+        if self.pending_since is not None and \
+                time.time() - self.pending_since >= self.flush_interval:
+            self.flush()
+
+    def flush_timeout(self):
+        """
+        Return the seconds until the buffered changes are due, or None if
+        there are none that can be sent.
+        """
+        if self.pending_since is None or not self.use_success:
+            return None
+        return max(0, self.pending_since + self.flush_interval - time.time())
+
+    def flush(self):
+        """
+        Send the buffered changes in one message: the delete events followed
+        by one change event. Nothing is sent before the SO is in use.
+        """
+        with self.lock:
+            if not self.use_success:
+                return
+            self.pending_since = None
+            if not self.pending_changes and not self.pending_deletes:
+                return
+
+            events = [SOEvent(SOEventTypes.DELETE, key)
+                for key in self.pending_deletes]
+            if self.pending_changes:
+                events.append(SOEvent(SOEventTypes.CHANGE,
+                    self.pending_changes))
+            self.pending_changes = {}
+            self.pending_deletes = set()
+
+            self.writer.write(SharedObjectMessage(self.name, events=events))
+            self.writer.flush()
+
     def handle_message(self, message):
         """
         Handle an incoming RTMP message. Check if it is of any relevance for the
         specific SO and process it, otherwise ignore it.
         """
-        if message['msg'] == DataTypes.SHARED_OBJECT and \
-            message['obj_name'] == self.name:
-            events = message['events']
+        if message.datatype != DataTypes.SHARED_OBJECT or \
+                message.obj_name != self.name:
+            return False
+        events = message.events
 
+        with self.lock:
             if not self.use_success:
-                assert events[0]['type'] == SOEventTypes.USE_SUCCESS, events[0]
-                assert events[1]['type'] == SOEventTypes.CLEAR, events[1]
-                events = events[2:]
+                assert events[0].type == SOEventTypes.USE_SUCCESS, events[0]
+                assert events[1].type == SOEventTypes.CLEAR, events[1]
                 self.use_success = True
+                self.handle_events(events[2:])
+                # The changes made before the use was confirmed win over the
+                # data of the server.
+                self.data.update(self.pending_changes)
+                for key in self.pending_deletes:
+                    self.data.pop(key, None)
+                self.flush()
+                return True
 
             self.handle_events(events)
             return True
-        else:
-            return False
 
     def handle_events(self, events):
-        """ Handle SO events that target the specific SO. """
+        """
+        Handle SO events that target the specific SO. The changed properties
+        are reported with a single on_changes call.
+        """
+        changed = []
         for event in events:
-            event_type = event['type']
+            event_type = event.type
             if event_type == SOEventTypes.CHANGE:
-                for key in event['data']:
-                    self.data[key] = event['data'][key]
-                    self.on_change(key)
+                for key in event.data:
+                    self.data[key] = event.data[key]
+                    changed.append(key)
             elif event_type == SOEventTypes.DELETE:
-                key = event['data']
+                key = event.data
                 assert key in self.data, (key,self.data.keys())
                 del self.data[key]
                 self.on_delete(key)
             elif event_type == SOEventTypes.MESSAGE:
-                self.on_message(event['data'])
+                self.on_message(event.data)
             else:
                 assert False, event
 
+        if changed:
+            self.on_changes(changed)
+
+    def on_changes(self, keys):
+        """
+        Called once per received message with the properties that it changed.
+        By default on_change is called for each one of them.
+        """
+        for key in keys:
+            self.on_change(key)
+
     def on_change(self, key):
         pass
 
@@ -386,8 +1580,266 @@ class FlashSharedObject:
     def on_message(self, data):
         pass
 
+class SharedObjectState:
+    """
+    The data, version and subscribers of a shared object on the server side.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.data = {}
+        self.version = 0
+        self.subscribers = set()
+        self.snapshot = None
+
+    def snapshot_message(self):
+        """
+        Return the reply to a use event: the use success and clear events
+        followed by the current data. The reply is prepared once per version
+        and shared by all the subscribers that use the shared object.
+        """
+        if self.snapshot is None:
+            events = [
+                SOEvent(SOEventTypes.USE_SUCCESS),
+                SOEvent(SOEventTypes.CLEAR),
+            ]
+            if self.data:
+                events.append(SOEvent(SOEventTypes.CHANGE, dict(self.data)))
+            self.snapshot = PreparedMessage(SharedObjectMessage(self.name,
+                self.version, events=events))
+        return self.snapshot
+
+class SharedObjectRegistry:
+    """
+    Keeps the remote shared objects of a server. A subscriber is any object
+    with a send_message(message) method, e.g. a client connection.
+
+    A subscriber that uses a shared object gets a snapshot of its data. Every
+    update (from a subscriber or from the server itself) increments the
+    version of the shared object and only the actual changes are sent to the
+    other subscribers. They are encoded once for all of them.
+
+    If a listener is set, it is notified of the actual changes of every update
+    and of every message event, except of those that originate from itself:
+    its shared_object_updated(name, changes, deletes) and
+    shared_object_message(name, data) methods are called. This is used to
+    replicate the shared objects, e.g. between the worker processes of a
+    server.
+    """
+
+    def __init__(self):
+        self.shared_objects = {}
+        self.subscriptions = {}
+        self.listener = None
+
+    def get(self, name):
+        """ Return the state of a shared object, creating it if needed. """
+        so = self.shared_objects.get(name)
+        if so is None:
+            so = self.shared_objects[name] = SharedObjectState(name)
+        return so
+
+    def handle_message(self, subscriber, message):
+        """
+        Handle a shared object message received from a subscriber. The use
+        and release events (un)subscribe it, the change and delete events
+        update the shared object and the message events are sent to all the
+        subscribers.
+        """
+        so = self.get(message.obj_name)
+        changes = {}
+        deletes = []
+
+        for event in message.events:
+            event_type = event.type
+            if event_type == SOEventTypes.USE:
+                so.subscribers.add(subscriber)
+                self.subscriptions.setdefault(subscriber, set()).add(so.name)
+                subscriber.send_message(so.snapshot_message())
+            elif event_type == SOEventTypes.RELEASE:
+                self.release(subscriber, so.name)
+            elif event_type == SOEventTypes.CHANGE:
+                changes.update(event.data)
+            elif event_type == SOEventTypes.DELETE:
+                changes.pop(event.data, None)
+                deletes.append(event.data)
+            elif event_type == SOEventTypes.MESSAGE:
+                self.broadcast_message(so.name, event.data)
+            else:
+                assert False, event
+
+        if changes or deletes:
+            self.update(so.name, changes, deletes, subscriber)
+
+    def update(self, name, changes, deletes=(), origin=None):
+        """
+        Delete and then change properties of a shared object and send the
+        changes to its subscribers, except to the origin of the update.
+        Properties that are set to their current value are left out.
+        """
+        so = self.get(name)
+        data = so.data
+
+        events = []
+        deleted = []
+        for key in deletes:
+            if key in data:
+                del data[key]
+                deleted.append(key)
+                events.append(SOEvent(SOEventTypes.DELETE, key))
+
+        changed = {}
+        for key in changes:
+            value = changes[key]
+            if key not in data or data[key] != value:
+                changed[key] = data[key] = value
+        if changed:
+            events.append(SOEvent(SOEventTypes.CHANGE, changed))
+
+        if not events:
+            return
+
+        so.version += 1
+        so.snapshot = None
+        self.broadcast(so, events, origin)
+        if self.listener is not None and origin is not self.listener:
+            self.listener.shared_object_updated(name, changed, deleted)
+
+    def broadcast_message(self, name, data, origin=None):
+        """
+        Send a message event to all the subscribers of a shared object, except
+        to the origin of the message.
+        """
+        self.broadcast(self.get(name), [SOEvent(SOEventTypes.MESSAGE, data)],
+            origin)
+        if self.listener is not None and origin is not self.listener:
+            self.listener.shared_object_message(name, data)
+
+    def broadcast(self, so, events, origin=None):
+        """
+        Send events to the subscribers of a shared object (except to the
+        origin), encoding them once.
+        """
+        if not so.subscribers:
+            return
+        message = PreparedMessage(SharedObjectMessage(so.name, so.version,
+            events=events))
+        # A subscriber may unsubscribe (e.g. be disconnected) while sending.
+        for subscriber in list(so.subscribers):
+            if subscriber is not origin:
+                subscriber.send_message(message)
+
+    def release(self, subscriber, name):
+        """ Unsubscribe a subscriber from a shared object. """
+        self.get(name).subscribers.discard(subscriber)
+        names = self.subscriptions.get(subscriber)
+        if names is not None:
+            names.discard(name)
+
+    def remove_subscriber(self, subscriber):
+        """
+        Unsubscribe a subscriber from all of its shared objects, e.g. when
+        its connection is closed.
+        """
+        for name in self.subscriptions.pop(subscriber, ()):
+            self.get(name).subscribers.discard(subscriber)
+
+class RtmpCallError(Exception):
+    """
+    Raised when a remote procedure call is answered with an _error reply. The
+    information object sent by the peer is available as the info attribute.
+    """
+
+    def __init__(self, info):
+        Exception.__init__(self, info)
+        self.info = info
+
+class RtmpCallTimeout(RtmpCallError):
+    """ Raised when the reply to a remote procedure call is late. """
+
+class PendingCall:
+    """
+    A remote procedure call that is in flight. It is resolved when the _result
+    or _error reply with the matching transaction id arrives; any number of
+    calls can be pending on one connection at the same time.
+    """
+
+    def __init__(self, client, trans_id):
+        """ Initialize an unresolved call with the given transaction id. """
+        self.client = client
+        self.trans_id = trans_id
+        self.done = False
+        self.result = None
+        self.error = None
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        """
+        Register a callback that is called with this call once it is resolved.
+        If the call has already been resolved the callback is called at once.
+        """
+        if self.done:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def resolve(self, msg):
+        """ Resolve the call with its _result or _error reply. """
+        command = msg.command
+        if command[0] == '_error':
+            self.error = command[3:]
+        else:
+            self.result = command[3:]
+        self.done = True
+        for callback in self.callbacks:
+            callback(self)
+        self.callbacks = []
+
+    def cancel(self):
+        """
+        Stop waiting for the reply: the call is forgotten by the client and a
+        late reply is handled as an unhandled message.
+        """
+        self.client.pending_calls.pop(self.trans_id, None)
+
+    def wait(self, timeout=None):
+        """
+        Handle incoming messages until the reply to this call arrives. Returns
+        the values that follow the command object of the _result reply (a
+        single value is returned as is). Raises RtmpCallError for an _error
+        reply. If the reply does not arrive within timeout seconds, the call is
+        cancelled and RtmpCallTimeout is raised. Buffered SO changes are sent
+        when they are due while waiting.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.done:
+            if deadline is not None and time.time() >= deadline:
+                self.cancel()
+                raise RtmpCallTimeout('no reply to transaction %d' %
+                    self.trans_id)
+            self.client.handle_next(deadline)
+        if self.error is not None:
+            raise RtmpCallError(self.error[0] if len(self.error) == 1 else
+                self.error)
+        return self.result[0] if len(self.result) == 1 else self.result
+
 class RtmpClient:
-    """ Represents an RTMP client. """
+    """
+    Represents an RTMP client. The outbound chunk size that is announced to
+    the server after connecting can be configured through the chunk_size and
+    adaptive_chunk_size attributes. A metrics collector set as the metrics
+    attribute before connecting is attached to the stream, the reader and the
+    writer. The traffic is captured by a capture writer (see rtmp_capture)
+    set as the capture attribute before connecting.
+
+    Calls and SO changes may be made by other threads while the message loop
+    runs; other code that writes through the writer holds the lock attribute.
+    """
+
+    chunk_size = 4096
+    adaptive_chunk_size = False
+    metrics = None
+    capture = None
 
     def __init__(self, ip, port, tc_url, page_url, swf_url, app):
         """ Initialize a new RTMP client. """
@@ -397,37 +1849,62 @@ class RtmpClient:
         self.page_url = page_url
         self.swf_url = swf_url
         self.app = app
-        self.shared_objects = []
+        self.shared_objects = {}
+        # Held while messages are handled and written, so that other threads
+        # can send calls and SO changes while the message loop runs.
+        self.lock = threading.RLock()
+        # Wakes up the message loop when a SO change is buffered, created
+        # with the first SO.
+        self.wakeup_receiver = None
+        self.wakeup_sender = None
+        # Transaction id 1 is used by the connect command.
+        self.next_trans_id = 2
+        self.pending_calls = {}
+        # Received bytes are acknowledged every ack_window bytes, the server
+        # is asked to acknowledge every window_ack_size bytes.
+        self.ack_window = None
+        self.last_ack = 0
+        self.window_ack_size = None
+        # Received messages are routed by datatype, commands by name, call
+        # replies by transaction id and SO messages by SO name.
+        self.message_handlers = {
+            DataTypes.USER_CONTROL: self.handle_user_control,
+            DataTypes.SET_CHUNK_SIZE: self.handle_set_chunk_size,
+            DataTypes.COMMAND: self.handle_command,
+            DataTypes.SHARED_OBJECT: self.handle_shared_object,
+        }
+        self.message_handlers[DataTypes.WINDOW_ACK_SIZE] = \
+            self.handle_window_ack_size
+        self.message_handlers[DataTypes.SET_PEER_BANDWIDTH] = \
+            self.handle_set_peer_bandwidth
+        self.message_handlers[DataTypes.ACKNOWLEDGEMENT] = \
+            self.handle_acknowledgement
+        self.command_handlers = {
+            '_result': self.handle_call_result,
+            '_error': self.handle_call_result,
+        }
 
     def handshake(self):
-        """ Perform the handshake sequence with the server. """
-        self.stream.write_uchar(3)
-        c1 = rtmp_protocol_base.Packet()
-        c1.first = 0
-        c1.second = 0
-        c1.payload = 'x'*1528
-        c1.encode(self.stream)
+        """
+        Perform the handshake sequence with the server. C0 and C1 are sent
+        with a single write and the echo of C1 (S2) is checked.
+        """
+        c1 = rtmp_protocol_base.handshake_packet()
+        self.stream.write('\x03' + c1)
         self.stream.flush()
 
-        self.stream.read_uchar()
-        s1 = rtmp_protocol_base.Packet()
-        s1.decode(self.stream)
+        s1 = self.stream.read(1 + rtmp_protocol_base.HANDSHAKE_LENGTH)[1:]
 
-        c2 = rtmp_protocol_base.Packet()
-        c2.first = s1.first
-        c2.second = s1.second
-        c2.payload = s1.payload
-        c2.encode(self.stream)
+        # C2 echoes S1.
+        self.stream.write(s1)
         self.stream.flush()
 
-        s2 = rtmp_protocol_base.Packet()
-        s2.decode(self.stream)
+        s2 = self.stream.read(rtmp_protocol_base.HANDSHAKE_LENGTH)
+        rtmp_protocol_base.check_handshake_echo(c1, s2)
 
     def connect_rtmp(self, connect_params):
         """ Initiate a NetConnection with a Flash Media Server. """
-        msg = {
-            'msg': DataTypes.COMMAND,
-            'command':
+        msg = CommandMessage(
             [
                 u'connect',
                 1,
@@ -445,8 +1922,8 @@ class RtmpClient:
                     'objectEncoding': 0
                 }
             ]
-        }
-        msg['command'].extend(connect_params)
+        )
+        msg.command.extend(connect_params)
         self.writer.write(msg)
         self.writer.flush()
 
@@ -454,40 +1931,93 @@ class RtmpClient:
             msg = self.reader.next()
             if self.handle_message_pre_connect(msg):
                 break
+            self.acknowledge_received()
 
-    def call(self, proc_name, parameters = {}, trans_id = 0):
-        """ Runs remote procedure calls (RPC) at the receiving end. """
-        msg = {
-            'msg': DataTypes.COMMAND,
-            'command':
+        self.writer.adaptive_chunk_size = self.adaptive_chunk_size
+        self.writer.set_chunk_size(self.chunk_size)
+        self.writer.flush()
+
+    def call(self, proc_name, parameters = {}, args = ()):
+        """
+        Runs remote procedure calls (RPC) at the receiving end. The arguments
+        that follow the command object are given as a list. A transaction id
+        is allocated for the call and a PendingCall is returned without
+        waiting for the reply, so several calls can be pipelined before
+        waiting for any of them. Calls that the peer does not answer are
+        sent with notify().
+        """
+        if not isinstance(args, (list, tuple)):
+            raise TypeError('the arguments of call() are a list, the '
+                'transaction id is allocated (use notify() for calls without '
+                'a reply)')
+        trans_id = self.next_trans_id
+        self.next_trans_id += 1
+        pending_call = PendingCall(self, trans_id)
+        self.pending_calls[trans_id] = pending_call
+        self.send_command(proc_name, trans_id, parameters, args)
+        return pending_call
+
+    def notify(self, proc_name, parameters = {}, args = ()):
+        """
+        Runs a remote procedure without a reply: it is sent with transaction
+        id 0 and nothing waits for an answer.
+        """
+        self.send_command(proc_name, 0, parameters, args)
+
+    def send_command(self, proc_name, trans_id, parameters, args):
+        """ Send an RPC command message. """
+        msg = CommandMessage(
             [
                 proc_name,
                 trans_id,
                 parameters
             ]
-        }
-        self.writer.write(msg)
-        self.writer.flush()
+        )
+        msg.command.extend(args)
+        with self.lock:
+            self.writer.write(msg)
+            self.writer.flush()
+
+    def wait_readable(self, timeout):
+        """
+        Wait up to timeout seconds (forever if None) for incoming data. Return
+        True if there is some, False if the timeout elapsed, or None if the
+        wait was ended early by wakeup(). The socket file reads exactly the
+        requested bytes, so no data is left buffered in it between messages.
+        """
+        if timeout is not None:
+            timeout = max(0, timeout)
+        sockets = [self.socket]
+        if self.wakeup_receiver is not None:
+            sockets.append(self.wakeup_receiver)
+        readable = select.select(sockets, [], [], timeout)[0]
+        if self.socket in readable:
+            return True
+        if self.wakeup_receiver is not None and \
+                self.wakeup_receiver in readable:
+            self.wakeup_receiver.recv(4096)
+            return None
+        return False
 
     def handle_message_pre_connect(self, msg):
         """ Handle messages arriving before the connection is established. """
-        if msg['msg'] == DataTypes.COMMAND:
-            assert msg['command'][0] == '_result', msg
-            assert msg['command'][1] == 1, msg
-            assert msg['command'][3]['code'] == \
+        datatype = msg.datatype
+        if datatype == DataTypes.COMMAND:
+            assert msg.command[0] == '_result', msg
+            assert msg.command[1] == 1, msg
+            assert msg.command[3]['code'] == \
                 'NetConnection.Connect.Success', msg
             return True
-        elif msg['msg'] == DataTypes.WINDOW_ACK_SIZE:
-            assert msg['window_ack_size'] == 2500000, msg
-        elif msg['msg'] == DataTypes.SET_PEER_BANDWIDTH:
-            assert msg['window_ack_size'] == 2500000, msg
-            assert msg['limit_type'] == 2, msg
-        elif msg['msg'] == DataTypes.USER_CONTROL:
-            assert msg['event_type'] == UserControlTypes.STREAM_BEGIN, msg
-            assert msg['event_data'] == '\x00\x00\x00\x00', msg
-        elif msg['msg'] == DataTypes.SET_CHUNK_SIZE:
-            assert msg['chunk_size'] > 0 and msg['chunk_size'] <= 65536, msg
-            self.reader.chunk_size = msg['chunk_size']
+        elif datatype == DataTypes.WINDOW_ACK_SIZE:
+            self.handle_window_ack_size(msg)
+        elif datatype == DataTypes.SET_PEER_BANDWIDTH:
+            self.handle_set_peer_bandwidth(msg)
+        elif datatype == DataTypes.USER_CONTROL:
+            assert msg.event_type == UserControlTypes.STREAM_BEGIN, msg
+            assert msg.event_data == '\x00\x00\x00\x00', msg
+        elif datatype == DataTypes.SET_CHUNK_SIZE:
+            assert msg.chunk_size > 0 and msg.chunk_size <= 65536, msg
+            self.reader.chunk_size = msg.chunk_size
         else:
             assert False, msg
 
@@ -498,50 +2028,192 @@ class RtmpClient:
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.connect((self.ip, self.port))
         self.file = self.socket.makefile()
-        self.stream = FileDataTypeMixIn(self.file)
+        if self.capture is not None:
+            # The capture has to see the writes, they go through the file.
+            self.file = self.capture.wrap(self.file)
+            self.stream = FileDataTypeMixIn(self.file)
+        else:
+            self.stream = FileDataTypeMixIn(self.file, self.socket)
+        self.stream.metrics = self.metrics
 
+        start = time.time()
         self.handshake()
+        if self.metrics is not None:
+            self.metrics.handshake_completed(time.time() - start)
 
         self.reader = RtmpReader(self.stream)
         self.writer = RtmpWriter(self.stream)
+        self.reader.metrics = self.metrics
+        self.writer.metrics = self.metrics
 
         self.connect_rtmp(connect_params)
 
     def shared_object_use(self, so):
-        """ Use a shared object and add it to the managed list of SOs. """
-        if so in self.shared_objects:
-            return
-        so.use(self.reader, self.writer)
-        self.shared_objects.append(so)
+        """ Use a shared object and add it to the managed SOs. """
+        with self.lock:
+            if so.name in self.shared_objects:
+                return
+            if self.wakeup_receiver is None:
+                self.wakeup_receiver, self.wakeup_sender = \
+                    socket.socketpair()
+                self.wakeup_sender.setblocking(False)
+            so.wakeup = self.wakeup
+            so.lock = self.lock
+            so.use(self.reader, self.writer)
+            self.shared_objects[so.name] = so
+
+    def register_message_handler(self, datatype, handler):
+        """
+        Register the handler of the received messages of a datatype, replacing
+        the current one. The handler is called with the message and returns
+        whether it handled it.
+        """
+        self.message_handlers[datatype] = handler
+
+    def register_command_handler(self, name, handler):
+        """
+        Register the handler of the received commands with the given name
+        (e.g. onStatus or an RPC invoked by the server), replacing the current
+        one. The handler is called with the message and returns whether it
+        handled it.
+        """
+        self.command_handlers[name] = handler
 
     def handle_messages(self):
-        """ Start the message handling loop. """
+        """
+        Start the message handling loop. Once a SO is used, the loop waits
+        for incoming data or for a SO change to be buffered (possibly by
+        another thread), and while SO changes are buffered it waits no longer
+        than until they are due, so that they are sent even if no message
+        arrives.
+        """
         while True:
-            msg = self.reader.next()
+            self.handle_next()
 
-            handled = self.handle_simple_message(msg)
+    def handle_next(self, deadline=None):
+        """
+        Wait for the next message until deadline (a time.time() value,
+        forever if None) and handle it if it arrived. The wait ends early
+        when buffered SO changes are due or when wakeup() is called. The SO
+        changes that are due are sent in any case.
+        """
+        timeout = self.flush_timeout()
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        # Without a SO and a deadline there is nothing to wait for but data.
+        if (timeout is None and not self.shared_objects) or \
+                self.wait_readable(timeout):
+            self.handle_message(self.reader.next())
+        self.flush_shared_objects()
+
+    def flush_timeout(self):
+        """
+        Return the seconds until SO changes are due to be sent, or None if no
+        change is buffered.
+        """
+        timeout = None
+        for so in self.shared_objects.itervalues():
+            so_timeout = so.flush_timeout()
+            if so_timeout is not None and \
+                    (timeout is None or so_timeout < timeout):
+                timeout = so_timeout
+        return timeout
+
+    def wakeup(self):
+        """
+        Wake up the message loop from wait_readable. Can be called from any
+        thread.
+        """
+        try:
+            self.wakeup_sender.send('\x00')
+        except socket.error:
+            # The loop has not consumed a previous wake up yet.
+            pass
+
+    def handle_message(self, msg):
+        """ Handle one incoming message. """
+        with self.lock:
+            handler = self.message_handlers.get(msg.datatype)
+            if handler is None or not handler(msg):
+                self.handle_unhandled_message(msg)
+            self.acknowledge_received()
+
+    def acknowledge_received(self):
+        """
+        Acknowledge the received bytes if the window announced by the server
+        has been filled since the last acknowledgement.
+        """
+        bytes_read = self.stream.bytes_read
+        if self.ack_window and bytes_read - self.last_ack >= self.ack_window:
+            self.writer.write(AcknowledgementMessage(bytes_read & 0xffffffff))
+            self.writer.flush()
+            self.last_ack = bytes_read
+
+    def handle_unhandled_message(self, msg):
+        """ Called with the messages that no handler handled. """
+        logging.warning('unhandled message %r', msg)
+
+    def flush_shared_objects(self):
+        """ Send the buffered changes of the SOs that are due. """
+        with self.lock:
+            for so in self.shared_objects.itervalues():
+                so.flush_if_due()
+
+    def handle_command(self, msg):
+        """ Route a command to the handler registered for its name. """
+        handler = self.command_handlers.get(msg.command[0])
+        return handler is not None and handler(msg)
+
+    def handle_shared_object(self, msg):
+        """ Route a shared object message to its SO. """
+        so = self.shared_objects.get(msg.obj_name)
+        return so is not None and so.handle_message(msg)
+
+    def handle_call_result(self, msg):
+        """ Resolve the pending call that a _result or _error reply answers. """
+        if msg.datatype != DataTypes.COMMAND or \
+                msg.command[0] not in ('_result', '_error'):
+            return False
+        pending_call = self.pending_calls.pop(msg.command[1], None)
+        if pending_call is None:
+            return False
+        pending_call.resolve(msg)
+        return True
 
-            if handled:
-                continue
+    def handle_user_control(self, msg):
+        """ Answer ping requests. """
+        if msg.event_type != UserControlTypes.PING_REQUEST:
+            return False
+        resp = UserControlMessage(UserControlTypes.PING_RESPONSE,
+            msg.event_data)
+        self.writer.write(resp)
+        self.writer.flush()
+        return True
 
-            for so in self.shared_objects:
-                if so.handle_message(msg):
-                    handled = True
-                    break
-            if not handled:
-                assert False, msg
-
-    def handle_simple_message(self, msg):
-        """ Handle simple messages, e.g. ping requests. """
-        if msg['msg'] == DataTypes.USER_CONTROL and msg['event_type'] == \
-                UserControlTypes.PING_REQUEST:
-            resp = {
-                'msg':DataTypes.USER_CONTROL,
-                'event_type':UserControlTypes.PING_RESPONSE,
-                'event_data':msg['event_data'],
-            }
-            self.writer.write(resp)
+    def handle_set_chunk_size(self, msg):
+        """ Apply the chunk size announced by the server. """
+        assert msg.chunk_size > 0 and msg.chunk_size <= 65536, msg
+        self.reader.chunk_size = msg.chunk_size
+        return True
+
+    def handle_window_ack_size(self, msg):
+        """ Acknowledge the received bytes in the window set by the server. """
+        self.ack_window = msg.window_ack_size
+        return True
+
+    def handle_set_peer_bandwidth(self, msg):
+        """
+        Ask the server to acknowledge the bytes it receives in the window that
+        it set as the limit of the unacknowledged bytes.
+        """
+        if msg.window_ack_size != self.window_ack_size:
+            self.writer.write(WindowAckSizeMessage(msg.window_ack_size))
             self.writer.flush()
-            return True
+            self.window_ack_size = msg.window_ack_size
+        return True
 
-        return False
+    def handle_acknowledgement(self, msg):
+        """ Acknowledgements from the server need no action. """
+        return True
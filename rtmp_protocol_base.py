@@ -2,9 +2,43 @@
 # rtmpy/protocol/handshake.py
 # rtmpy/protocol/rtmp/header.py
 
+import os
+import random
+import struct
 import time
 
 HANDSHAKE_LENGTH = 1536
+HANDSHAKE_POOL_SIZE = 64
+
+# Pool of precomputed C1/S1 handshake packets.
+_handshake_packets = []
+
+class HandshakeError(Exception):
+    """
+    Raised when the peer does not echo the handshake packet that was sent to
+    it.
+    """
+
+def handshake_packet():
+    """
+    Returns a handshake packet (C1 or S1) to send: a zero time, 4 zero bytes
+    and random bytes. The packets are taken from a pool that is generated on
+    first use, so that setting up a connection costs no random number
+    generation and no encoding.
+    """
+    if not _handshake_packets:
+        for i in xrange(HANDSHAKE_POOL_SIZE):
+            _handshake_packets.append('\x00' * 8 +
+                os.urandom(HANDSHAKE_LENGTH - 8))
+    return random.choice(_handshake_packets)
+
+def check_handshake_echo(sent, echo):
+    """
+    Checks that the echo (C2 or S2) of a handshake packet contains its random
+    bytes. The time fields are not compared as peers may set them.
+    """
+    if len(echo) != HANDSHAKE_LENGTH or echo[8:] != sent[8:]:
+        raise HandshakeError('The peer did not echo the handshake packet')
 
 class Packet(object):
     """
@@ -54,112 +88,210 @@ class Packet(object):
 
         self.payload = buffer.read(HANDSHAKE_LENGTH - 8)
 
-def header_decode(stream):
+# Precompiled structs for the header fields. 24 bit fields are split into a
+# high byte and a low short.
+_UCHAR = struct.Struct('!B')
+_CHANNEL_ID = struct.Struct('<H')
+_TIMESTAMP = struct.Struct('!BH')
+_MESSAGE_HEADER = struct.Struct('!BHBHB')
+_STREAM_ID = struct.Struct('<L')
+_EXTENDED_TIMESTAMP = struct.Struct('!L')
+
+def _header_size(first_byte):
     """
-    Reads a header from the incoming stream.
+    Returns the size of a header (without the extended timestamp) given its
+    first byte.
+    """
+    size = (11, 7, 3, 0)[first_byte >> 6] + 1
+    channelId = first_byte & 0x3f
+    if channelId == 0:
+        size += 1
+    elif channelId == 1:
+        size += 2
+    return size
 
-    A header can be of varying lengths and the properties that get updated
-    depend on the length.
+_HEADER_SIZES = tuple(_header_size(first_byte) for first_byte in xrange(256))
 
-    @param stream: The byte stream to read the header from.
-    @type stream: C{pyamf.util.BufferedByteStream}
-    @return: The read header from the stream.
-    @rtype: L{Header}
+# Encoded basic headers (format bits and channel id), keyed by both.
+_basic_headers = {}
+
+def _basic_header(size, channelId):
     """
-    # read the size and channelId
-    channelId = stream.read_uchar()
-    bits = channelId >> 6
-    channelId &= 0x3f
+    Returns the encoded basic header for the given format bits and channel
+    id.
 
-    if channelId == 0:
-        channelId = stream.read_uchar() + 64
+    0 >= channelId > 64: channelId
+    64 >= channelId > 320: 0, channelId - 64
+    320 >= channelId > 0xffff + 64: 1, channelId - 64 (written as 2 byte int)
+    """
+    basic = _basic_headers.get((size, channelId))
+    if basic is not None:
+        return basic
 
-    if channelId == 1:
-        channelId = stream.read_uchar() + 64 + (stream.read_uchar() << 8)
+    if channelId < 64:
+        basic = _UCHAR.pack(size | channelId)
+    elif channelId < 320:
+        basic = _UCHAR.pack(size) + _UCHAR.pack(channelId - 64)
+    else:
+        basic = _UCHAR.pack(size + 1) + _CHANNEL_ID.pack(channelId - 64)
 
-    header = Header(channelId)
+    _basic_headers[(size, channelId)] = basic
+    return basic
 
-    if bits == 3:
-        return header
+def header_decode_from(buf, offset=0):
+    """
+    Decodes a header from a buffer starting at the given offset.
+
+    @param buf: The buffer to decode the header from.
+    @type buf: C{str}, C{bytearray} or C{memoryview}
+    @param offset: The position of the header in the buffer.
+    @return: The decoded header and the position right after it, or C{None}
+        if the buffer does not contain the whole header.
+    @rtype: C{tuple} of L{Header} and C{int}
+    """
+    end = len(buf)
+    if offset >= end:
+        return None
 
-    header.timestamp = stream.read_24bit_uint()
+    first_byte = _UCHAR.unpack_from(buf, offset)[0]
+    pos = offset + _HEADER_SIZES[first_byte]
+    if pos > end:
+        return None
 
-    if bits < 2:
-        header.bodyLength = stream.read_24bit_uint()
-        header.datatype = stream.read_uchar()
+    bits = first_byte >> 6
+    channelId = first_byte & 0x3f
+
+    if channelId == 0:
+        channelId = _UCHAR.unpack_from(buf, offset + 1)[0] + 64
+    elif channelId == 1:
+        channelId = _CHANNEL_ID.unpack_from(buf, offset + 1)[0] + 64
 
-    if bits < 1:
-        # streamId is little endian
-        stream.endian = '<'
-        header.streamId = stream.read_ulong()
-        stream.endian = '!'
+    header = Header(channelId)
 
+    if bits == 3:
+        return header, pos
+
+    if bits == 2:
+        high, low = _TIMESTAMP.unpack_from(buf, pos - 3)
+    elif bits == 1:
+        high, low, length_high, length_low, header.datatype = \
+            _MESSAGE_HEADER.unpack_from(buf, pos - 7)
+        header.bodyLength = (length_high << 16) | length_low
+    else:
+        high, low, length_high, length_low, header.datatype = \
+            _MESSAGE_HEADER.unpack_from(buf, pos - 11)
+        header.bodyLength = (length_high << 16) | length_low
+        header.streamId = _STREAM_ID.unpack_from(buf, pos - 4)[0]
         header.full = True
 
+    header.timestamp = (high << 16) | low
+
     if header.timestamp == 0xffffff:
-        header.timestamp = stream.read_ulong()
+        if pos + 4 > end:
+            return None
+        header.timestamp = _EXTENDED_TIMESTAMP.unpack_from(buf, pos)[0]
+        pos += 4
 
-    return header
+    return header, pos
 
-def header_encode(stream, header, previous=None):
+def header_decode(stream):
     """
-    Encodes a RTMP header to C{stream}.
+    Reads a header from the incoming stream.
 
-    We expect the stream to already be in network endian mode.
+    A header can be of varying lengths and the properties that get updated
+    depend on the length.
 
-    The channel id can be encoded in up to 3 bytes. The first byte is special as
-    it contains the size of the rest of the header as described in
-    L{getHeaderSize}.
+    @param stream: The byte stream to read the header from.
+    @type stream: C{pyamf.util.BufferedByteStream}
+    @return: The read header from the stream.
+    @rtype: L{Header}
+    """
+    data = stream.read(1)
+    if len(data) != 1:
+        raise IOError('Tried to read 1 byte(s) from the stream')
+
+    size = _HEADER_SIZES[ord(data)]
+    if size > 1:
+        data += stream.read(size - 1)
+    if len(data) != size:
+        raise IOError('Tried to read %d byte(s) from the stream' % size)
+
+    result = header_decode_from(data)
+    if result is None:
+        # The extended timestamp follows.
+        data += stream.read(4)
+        result = header_decode_from(data)
+        if result is None:
+            raise IOError('Tried to read 4 byte(s) from the stream')
+
+    return result[0]
+
+def header_encode_into(buf, offset, header, previous=None):
+    """
+    Encodes a RTMP header into a buffer (e.g. a reusable C{bytearray}).
 
-    0 >= channelId > 64: channelId
-    64 >= channelId > 320: 0, channelId - 64
-    320 >= channelId > 0xffff + 64: 1, channelId - 64 (written as 2 byte int)
+    The buffer must have room for the header at the given offset: up to 18
+    bytes.
 
-    @param stream: The stream to write the encoded header.
-    @type stream: L{util.BufferedByteStream}
+    @param buf: The writable buffer to encode the header into.
+    @param offset: The position to encode the header at.
     @param header: The L{Header} to encode.
     @param previous: The previous header (if any).
+    @return: The position right after the encoded header.
+    @rtype: C{int}
     """
     if previous is None:
         size = 0
     else:
         size = min_bytes_required(header, previous)
 
-    channelId = header.channelId
+    basic = _basic_header(size, header.channelId)
+    pos = offset + len(basic)
+    buf[offset:pos] = basic
 
-    if channelId < 64:
-        stream.write_uchar(size | channelId)
-    elif channelId < 320:
-        stream.write_uchar(size)
-        stream.write_uchar(channelId - 64)
+    if size == 0xc0:
+        return pos
+
+    timestamp = header.timestamp
+    if timestamp >= 0xffffff:
+        field = 0xffffff
     else:
-        channelId -= 64
+        field = timestamp
 
-        stream.write_uchar(size + 1)
-        stream.write_uchar(channelId & 0xff)
-        stream.write_uchar(channelId >> 0x08)
+    if size == 0x80:
+        _TIMESTAMP.pack_into(buf, pos, field >> 16, field & 0xffff)
+        pos += 3
+    else:
+        bodyLength = header.bodyLength
+        _MESSAGE_HEADER.pack_into(buf, pos, field >> 16, field & 0xffff,
+            bodyLength >> 16, bodyLength & 0xffff, header.datatype)
+        pos += 7
+        if size == 0:
+            _STREAM_ID.pack_into(buf, pos, header.streamId)
+            pos += 4
 
-    if size == 0xc0:
-        return
-
-    if size <= 0x80:
-        if header.timestamp >= 0xffffff:
-            stream.write_24bit_uint(0xffffff)
-        else:
-            stream.write_24bit_uint(header.timestamp)
-
-    if size <= 0x40:
-        stream.write_24bit_uint(header.bodyLength)
-        stream.write_uchar(header.datatype)
-
-    if size == 0:
-        stream.endian = '<'
-        stream.write_ulong(header.streamId)
-        stream.endian = '!'
-
-    if size <= 0x80:
-        if header.timestamp >= 0xffffff:
-            stream.write_ulong(header.timestamp)
+    if field == 0xffffff:
+        _EXTENDED_TIMESTAMP.pack_into(buf, pos, timestamp)
+        pos += 4
+
+    return pos
+
+def header_encode(stream, header, previous=None):
+    """
+    Encodes a RTMP header to C{stream}.
+
+    The channel id can be encoded in up to 3 bytes. The first byte is special as
+    it contains the size of the rest of the header as described in
+    L{getHeaderSize}.
+
+    @param stream: The stream to write the encoded header.
+    @type stream: L{util.BufferedByteStream}
+    @param header: The L{Header} to encode.
+    @param previous: The previous header (if any).
+    """
+    buf = bytearray(18)
+    pos = header_encode_into(buf, 0, header, previous)
+    stream.write(bytes(buf[:pos]))
 
 class Header(object):
     """
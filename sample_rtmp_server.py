@@ -1,139 +1,511 @@
 """ Sample implementation of an RTMP server. """
 
-import pyamf.util
-import rtmp_protocol_base
+import asyncore
+import collections
+import errno
+import logging
+import multiprocessing
+import os
+import rtmp_capture
 import rtmp_protocol
-import SocketServer
+import signal
+import socket
+import struct
+import sys
 import time
+import traceback
 
-class RTMPHandler(SocketServer.BaseRequestHandler):
-    """ Handles a client connection. """
+class RTMPConnection(asyncore.dispatcher):
+    """
+    Handles a client connection. All I/O is non-blocking: received bytes are
+    fed into a sans-IO protocol engine and its output is buffered until the
+    socket is writable.
 
-    WAITING_C1 = 0
-    WAITING_C2 = 1
-    WAITING_COMMAND_CONNECT = 2
-    WAITING_DATA = 3
+    The client is asked to acknowledge the bytes it receives. Once the client
+    has not acknowledged twice its window (it acknowledges once per window),
+    further messages are queued instead of written; a client whose queue
+    overflows is disconnected. Slow clients cannot make the output buffers
+    grow without limit.
+    """
 
-    def handle(self):
+    WAITING_COMMAND_CONNECT = 0
+    WAITING_DATA = 1
+
+    def __init__(self, sock, server):
+        """ Initialize the connection for an accepted client socket. """
+        asyncore.dispatcher.__init__(self, sock, server.socket_map)
+        self.server = server
+        self.protocol = rtmp_protocol.RtmpConnectionState(False)
+        self.protocol.writer.adaptive_chunk_size = server.adaptive_chunk_size
+        if server.metrics is not None:
+            self.protocol.set_metrics(server.metrics)
+        self.state = self.WAITING_COMMAND_CONNECT
+        self.out_buffer = bytearray()
+        self.queue = collections.deque()
+        self.closing = False
+        self.last_activity = time.time()
+        self.capture = None
+        if server.capture_dir is not None:
+            host, port = sock.getpeername()[:2]
+            self.capture = rtmp_capture.CaptureWriter(os.path.join(
+                server.capture_dir, '%d-%s-%d.rtmpcap' % (
+                    int(time.time() * 1000), host, port)))
+
+    def readable(self):
+        return not self.closing
+
+    def writable(self):
+        return len(self.out_buffer) > 0
+
+    def handle_read(self):
         """
-        This method gets called when a client connects to the RTMP server. It
-        implements a state machine.
+        This method gets called when data arrives from the client. It feeds
+        the protocol engine (which takes care of the handshake) and runs the
+        state machine for every message that is completed.
         """
-        state = self.WAITING_C1
-        self.state2 = 0
-        f = self.request.makefile()
-        self.sock_stream = rtmp_protocol.FileDataTypeMixIn(f)
-        self.reader = rtmp_protocol.RtmpReader(self.sock_stream)
-        self.writer = rtmp_protocol.RtmpWriter(self.sock_stream)
+        data = self.recv(65536)
+        if not data:
+            return
+        self.last_activity = time.time()
+        if self.capture is not None:
+            self.capture.record(rtmp_capture.RECEIVED, data)
 
-        while True:
-            if state == self.WAITING_C1:
-                self.handle_C1()
-                state += 1
-            elif state == self.WAITING_C2:
-                self.handle_C2()
-                state += 1
-            elif state == self.WAITING_COMMAND_CONNECT:
-                self.handle_command_connect()
-                state += 1
-            elif state == self.WAITING_DATA:
-                self.handle_data()
+        for msg in self.protocol.feed(data):
+            if not self.connected:
+                # A slow client was disconnected by one of the messages (see
+                # send_message), the rest are dropped so that none of them
+                # subscribes it to a shared object again.
+                return
+            if self.state == self.WAITING_COMMAND_CONNECT:
+                self.handle_command_connect(msg)
+                self.state += 1
+            elif self.state == self.WAITING_DATA:
+                self.handle_data(msg)
             else:
-                assert False, state
-
-    def handle_C1(self):
-        """
-        Handle version byte and first handshake packet sent by client. Send
-        version byte and two handshake packets to client.
-        """
-        self.sock_stream.read_uchar()
-        c1 = rtmp_protocol_base.Packet()
-        c1.decode(self.sock_stream)
-
-        self.sock_stream.write_uchar(3)
-        s1 = rtmp_protocol_base.Packet(first=0,second=0,payload='x'*1528)
-        s1.encode(self.sock_stream)
-        s2 = rtmp_protocol_base.Packet(first=0,second=0,payload='x'*1528)
-        s2.encode(self.sock_stream)
-        self.sock_stream.flush()
-
-    def handle_C2(self):
-        """ Handle second handshake packet from client. """
-        c2 = rtmp_protocol_base.Packet()
-        c2.decode(self.sock_stream)
-
-    def handle_command_connect(self):
-        """ Handle the first RTMP message that initiates the connection. """
-        self.reader.next()
-        msg = {
-            'msg': rtmp_protocol.DataTypes.COMMAND,
-            'command':
-            [
-                u'_result',
-                1,
-                {'capabilities': 31, 'fmsVer': u'FMS/3,0,2,217'},
-                {
-                    'code': u'NetConnection.Connect.Success',
-                    'objectEncoding': 0,
-                    'description': u'Connection succeeded.',
-                    'level': u'status'
-                }
-            ]
-        }
-        self.writer.write(msg)
-        self.writer.flush()
-
-    def handle_data(self):
-        """
-        Handle additional RTMP messages from the client. In this sample
-        implementation the server waits for 2 shared object use events and
-        responds with the use_success, clear and change events for each one of
-        them.
-        """
-
-        msg = {
-            'msg': rtmp_protocol.DataTypes.SHARED_OBJECT,
-            'curr_version': 0,
-            'flags': '\x00\x00\x00\x00\x00\x00\x00\x00',
-            'events':
-            [
-                {
-                    'type':rtmp_protocol.SOEventTypes.USE_SUCCESS,
-                    'data':''
-                },
-                {
-                    'type':rtmp_protocol.SOEventTypes.CLEAR,
-                    'data':''
-                },
-                {
-                    'type': rtmp_protocol.SOEventTypes.CHANGE,
-                }
-            ]
-        }
-
-        if self.state2 == 0:
-            self.state2 += 1
-            print self.reader.next()
-            time.sleep(2)
-            msg['obj_name'] = 'so_name'
-            msg['events'][2]['data'] = {'sparam':'1234567890 '*5}
-            self.writer.write(msg)
-            self.writer.flush()
-        elif self.state2 == 1:
-            self.state2 += 1
-            print self.reader.next()
-            time.sleep(2)
-            msg['obj_name'] = 'so2_name'
-            msg['events'][2]['data'] = {'sparam':'QWERTY '*20}
-            self.writer.write(msg)
-            self.writer.flush()
+                assert False, self.state
+
+        self.out_buffer += self.protocol.data_to_send()
+        self.send_queued()
+
+    def handle_write(self):
+        """ Send as much of the buffered output as the socket accepts. """
+        sent = self.send(self.out_buffer)
+        if self.capture is not None:
+            self.capture.record(rtmp_capture.SENT, self.out_buffer[:sent])
+        del self.out_buffer[:sent]
+        if self.closing and not self.out_buffer:
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        self.server.shared_objects.remove_subscriber(self)
+        self.queue.clear()
+        if self.capture is not None:
+            self.capture.close()
+        asyncore.dispatcher.close(self)
+
+    def send_message(self, message):
+        """
+        Send a message to the client, or queue it if the client is congested.
+        Used by the shared object registry to send updates to any connection.
+        """
+        if self.queue or self.congested():
+            if len(self.queue) >= self.server.max_queued_messages:
+                logging.warning('Closing a slow client connection.')
+                self.close()
+                return
+            self.queue.append(message)
+            if self.server.metrics is not None:
+                self.server.metrics.message_queued(len(self.queue))
+            return
+        self.protocol.send(message)
+        self.out_buffer += self.protocol.data_to_send()
+
+    def send_queued(self):
+        """ Send the queued messages while the client is not congested. """
+        while self.queue and not self.congested():
+            self.protocol.send(self.queue.popleft())
+            self.out_buffer += self.protocol.data_to_send()
+
+    def congested(self):
+        """
+        Return whether the client has not acknowledged more than twice its
+        window.
+        """
+        window = self.protocol.window_ack_size
+        return window is not None and \
+            self.protocol.unacknowledged() > 2 * window
+
+    def shutdown(self):
+        """ Stop reading and close the connection once its output is sent. """
+        self.closing = True
+        if not self.out_buffer:
+            self.close()
+
+    def handle_command_connect(self, msg):
+        """
+        Handle the first RTMP message that initiates the connection. The
+        acknowledgement window, the bandwidth limit and the outbound chunk
+        size are announced before the reply.
+        """
+        self.protocol.set_window_ack_size(self.server.window_ack_size)
+        self.protocol.send(rtmp_protocol.SetPeerBandwidthMessage(
+            self.server.window_ack_size, 2))
+        self.protocol.writer.set_chunk_size(self.server.chunk_size)
+        self.protocol.send(self.server.connect_result)
+
+    def handle_data(self, msg):
+        """
+        Handle additional RTMP messages from the client. Shared object
+        messages are handled by the shared object registry of the server and
+        ping requests are answered.
+        """
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('received %r', msg)
+
+        if msg.datatype == rtmp_protocol.DataTypes.SHARED_OBJECT:
+            self.server.shared_objects.handle_message(self, msg)
+        elif msg.datatype == rtmp_protocol.DataTypes.USER_CONTROL and \
+                msg.event_type == rtmp_protocol.UserControlTypes.PING_REQUEST:
+            self.send_message(rtmp_protocol.UserControlMessage(
+                rtmp_protocol.UserControlTypes.PING_RESPONSE, msg.event_data))
+
+class RTMPServer(asyncore.dispatcher):
+    """
+    An event driven RTMP server that serves any number of concurrent client
+    connections from a single thread.
+    """
+
+    connection_class = RTMPConnection
+
+    def __init__(self, address, backlog=1024, idle_timeout=None,
+                 chunk_size=4096, adaptive_chunk_size=False,
+                 window_ack_size=2500000, max_queued_messages=1000,
+                 metrics=None, reuse_port=False, capture_dir=None):
+        """
+        Start listening on the given address. Connections that receive nothing
+        for idle_timeout seconds are closed (None disables the timeout). The
+        outbound chunk size is announced to every client when it connects and
+        is optionally adapted to the sizes of the messages sent to it. Clients
+        acknowledge every window_ack_size bytes; up to max_queued_messages are
+        queued for a congested client. A metrics collector (see rtmp_metrics)
+        is attached to every connection if given. With reuse_port, several
+        servers (processes) can listen on the same address with SO_REUSEPORT.
+        If capture_dir is given, the traffic of every connection is captured
+        to a file in it (see rtmp_capture).
+        """
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.idle_timeout = idle_timeout
+        self.chunk_size = chunk_size
+        self.adaptive_chunk_size = adaptive_chunk_size
+        self.window_ack_size = window_ack_size
+        self.max_queued_messages = max_queued_messages
+        self.metrics = metrics
+        self.capture_dir = capture_dir
+        # The time after which shutdown() stops waiting for the connections.
+        self.shutdown_deadline = None
+        # The reply to the connect command is the same for every client.
+        self.connect_result = rtmp_protocol.PreparedMessage(
+            rtmp_protocol.CommandMessage(
+                [
+                    u'_result',
+                    1,
+                    {'capabilities': 31, 'fmsVer': u'FMS/3,0,2,217'},
+                    {
+                        'code': u'NetConnection.Connect.Success',
+                        'objectEncoding': 0,
+                        'description': u'Connection succeeded.',
+                        'level': u'status'
+                    }
+                ]
+            )
+        )
+        # The shared objects that the sample client uses.
+        self.shared_objects = rtmp_protocol.SharedObjectRegistry()
+        self.shared_objects.update('so_name', {'sparam': '1234567890 '*5})
+        self.shared_objects.update('so2_name', {'sparam': 'QWERTY '*20})
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.bind(address)
+        self.listen(backlog)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, addr = pair
+        self.connection_class(sock, self)
+
+    def connections(self):
+        """ Return the currently open client connections. """
+        return [conn for conn in self.socket_map.values()
+            if isinstance(conn, RTMPConnection)]
+
+    def close_idle_connections(self):
+        """ Close the connections that exceeded the idle timeout. """
+        deadline = time.time() - self.idle_timeout
+        for conn in self.connections():
+            if conn.last_activity < deadline:
+                conn.close()
+
+    def serve_forever(self, poll_interval=1.0):
+        """
+        Run the event loop until shutdown() is called and all connections have
+        been closed (or its timeout expired).
+        """
+        now = last_check = time.time()
+        while self.socket_map:
+            timeout = poll_interval
+            if self.shutdown_deadline is not None:
+                timeout = max(0, min(timeout, self.shutdown_deadline - now))
+            asyncore.loop(timeout, True, self.socket_map, 1)
+            now = time.time()
+            if self.shutdown_deadline is not None and \
+                    now >= self.shutdown_deadline:
+                self.close_remaining()
+            elif self.idle_timeout is not None and \
+                    now - last_check >= min(poll_interval, self.idle_timeout):
+                last_check = now
+                self.close_idle_connections()
+
+    def close_remaining(self):
+        """
+        Close the connections (and links) that did not finish sending their
+        output before the shutdown timeout, e.g. clients that stopped reading.
+        """
+        dispatchers = self.socket_map.values()
+        if dispatchers:
+            logging.warning('Closing %d connections at the shutdown timeout',
+                len(dispatchers))
+        for dispatcher in dispatchers:
+            dispatcher.close()
+
+    def shutdown(self, timeout=10.0):
+        """
+        Gracefully shut the server down: stop accepting new connections and
+        close the existing ones (and the links to the other workers, if any)
+        after their pending output has been sent. serve_forever() closes the
+        connections that are still open after timeout seconds (None waits
+        for them without a limit).
+        """
+        self.close()
+        if timeout is not None:
+            self.shutdown_deadline = time.time() + timeout
+        for dispatcher in self.socket_map.values():
+            dispatcher.shutdown()
+
+class WorkerLink(asyncore.dispatcher):
+    """
+    One end of a Unix socket that connects two worker processes of a
+    pre-forked server. Sync messages are framed with their length.
+    """
+
+    def __init__(self, sock, sync, socket_map):
+        asyncore.dispatcher.__init__(self, sock, socket_map)
+        self.sync = sync
+        self.pending = ''
+        self.out_buffer = bytearray()
+
+    def writable(self):
+        return len(self.out_buffer) > 0
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        data = self.pending + data
+        pos = 0
+        while len(data) - pos >= 4:
+            length = struct.unpack_from('!L', data, pos)[0]
+            if len(data) - pos - 4 < length:
+                break
+            self.sync.handle_sync_message(data[pos + 4:pos + 4 + length])
+            pos += 4 + length
+        self.pending = data[pos:]
+
+    def handle_write(self):
+        sent = self.send(self.out_buffer)
+        del self.out_buffer[:sent]
+
+    def handle_close(self):
+        self.close()
+
+    def send_sync_message(self, payload):
+        """ Queue a sync message, it is sent when the socket is writable. """
+        self.out_buffer += struct.pack('!L', len(payload))
+        self.out_buffer += payload
+
+    def shutdown(self):
+        self.close()
+
+class SharedObjectSync:
+    """
+    Replicates the shared objects of a worker process to the other workers:
+    the updates and message events of the local registry are sent to every
+    other worker, which applies them to its own registry and sends them to its
+    own subscribers.
+
+    Concurrent changes of a property in different workers are resolved by the
+    last writer wins rule, so that all the workers end up with the same data:
+    updates are stamped with a Lamport clock and the worker id, and a
+    property is only changed by an update with a higher stamp than the one
+    that last changed it.
+    """
+
+    def __init__(self, server, worker_id, sockets):
+        """
+        Replicate the shared objects of the server over the sockets connected
+        to the other workers.
+        """
+        self.registry = server.shared_objects
+        self.worker_id = worker_id
+        self.clock = 0
+        self.stamps = {}
+        self.links = [WorkerLink(sock, self, server.socket_map)
+            for sock in sockets]
+        self.registry.listener = self
+
+    def shared_object_updated(self, name, changes, deletes):
+        self.clock += 1
+        stamp = (self.clock, self.worker_id)
+        for key in changes:
+            self.stamps[(name, key)] = stamp
+        for key in deletes:
+            self.stamps[(name, key)] = stamp
+        # The changes are sent as [key, value] pairs: the keys of an AMF
+        # object would be decoded as UTF-8 byte strings, not as the unicode
+        # keys of the shared objects.
+        self.send([u'update', name, self.clock, self.worker_id,
+            [[key, value] for key, value in changes.iteritems()], deletes])
+
+    def shared_object_message(self, name, data):
+        self.send([u'message', name, data])
+
+    def send(self, values):
+        """ Send a sync message to all the other workers. """
+        payload = rtmp_protocol.encode_amf_values(values)
+        for link in self.links:
+            if link.connected:
+                link.send_sync_message(payload)
+
+    def handle_sync_message(self, payload):
+        """ Apply a sync message received from another worker. """
+        values = rtmp_protocol.decode_amf_values(payload)
+        if values[0] == u'update':
+            name, clock, worker_id, changes, deletes = values[1:]
+            self.clock = max(self.clock, clock)
+            stamp = (clock, worker_id)
+            applied_changes = {}
+            applied_deletes = []
+            for key in deletes:
+                if self.stamps.get((name, key), (0, -1)) < stamp:
+                    self.stamps[(name, key)] = stamp
+                    applied_deletes.append(key)
+            for key, value in changes:
+                if self.stamps.get((name, key), (0, -1)) < stamp:
+                    self.stamps[(name, key)] = stamp
+                    applied_changes[key] = value
+            self.registry.update(name, applied_changes, applied_deletes, self)
+        elif values[0] == u'message':
+            self.registry.broadcast_message(values[1], values[2], self)
         else:
-            print self.reader.next()
+            assert False, values
 
-def main():
-    """ Start the RTMP server on 127.0.0.1 at port 80. """
-    server = SocketServer.TCPServer(('127.0.0.1', 80), RTMPHandler)
+def serve_prefork(address, workers=None, **server_args):
+    """
+    Serve from several worker processes (by default one per CPU), so that the
+    server is not limited to the one CPU that a Python process can use. Every
+    worker listens on the address with SO_REUSEPORT, the kernel balances the
+    connections between them. The workers are connected to each other by Unix
+    sockets over which the shared objects are replicated (see
+    SharedObjectSync), clients of different workers see the same shared
+    objects.
+
+    The server arguments are passed to every RTMPServer. Returns once all the
+    workers have exited; SIGTERM and SIGINT shut them down gracefully.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    sockets = [[None] * workers for i in xrange(workers)]
+    for i in xrange(workers):
+        for j in xrange(i + 1, workers):
+            sockets[i][j], sockets[j][i] = socket.socketpair()
+
+    pids = []
+    for i in xrange(workers):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                for j in xrange(workers):
+                    if j != i:
+                        for sock in sockets[j]:
+                            if sock is not None:
+                                sock.close()
+                run_worker(address, i,
+                    [sock for sock in sockets[i] if sock is not None],
+                    server_args)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        pids.append(pid)
+
+    for row in sockets:
+        for sock in row:
+            if sock is not None:
+                sock.close()
+
+    def stop(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for pid in pids:
+        while True:
+            try:
+                os.waitpid(pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    break
+
+def run_worker(address, worker_id, sockets, server_args):
+    """ Run one worker process of a pre-forked server. """
+    server = RTMPServer(address, reuse_port=True, **server_args)
+    SharedObjectSync(server, worker_id, sockets)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+    # The parent process shuts the workers down on SIGINT.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
     server.serve_forever()
 
+def main():
+    """
+    Start the RTMP server on 127.0.0.1 at port 80. If a number of worker
+    processes is given as argument, the server is pre-forked.
+    """
+    logging.basicConfig()
+    if len(sys.argv) > 1:
+        serve_prefork(('127.0.0.1', 80), int(sys.argv[1]), idle_timeout=300)
+        return
+
+    server = RTMPServer(('127.0.0.1', 80), idle_timeout=300)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+        server.serve_forever()
+
 if __name__ == '__main__':
     main()
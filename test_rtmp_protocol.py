@@ -0,0 +1,262 @@
+"""
+Tests for rtmp_protocol.
+"""
+
+import io
+import random
+import unittest
+
+import pyamf
+import pyamf.amf0
+import pyamf.util
+
+import rtmp_amf0
+import rtmp_protocol
+
+# A type 0 header on chunk stream 4 for a 10 byte audio message on message
+# stream 1, with the extended timestamp 0x01000000.
+FULL_EXTENDED_HEADER = '\x04\xff\xff\xff\x00\x00\x0a\x08\x01\x00\x00\x00' \
+    '\x01\x00\x00\x00'
+# A type 3 header on chunk stream 4, followed by the extended timestamp field.
+TYPE3_EXTENDED_HEADER = '\xc4\x01\x00\x00\x00'
+
+def encode_messages(messages, chunk_size=128):
+    """ Return the wire form of messages written by an RtmpWriter. """
+    writer = rtmp_protocol.RtmpWriter(
+        rtmp_protocol.FileDataTypeMixIn(io.BytesIO()))
+    writer.chunk_size = chunk_size
+    for message in messages:
+        writer.write(message)
+    return writer.stream.fileobject.getvalue()
+
+def read_messages(data, count, chunk_size=128):
+    """ Read count messages from their wire form with an RtmpReader. """
+    reader = rtmp_protocol.RtmpReader(
+        rtmp_protocol.FileDataTypeMixIn(io.BytesIO(data)))
+    reader.chunk_size = chunk_size
+    return [reader.next() for i in xrange(count)]
+
+def pyamf_encode(*values):
+    """ Encode values back to back with pyamf. """
+    stream = pyamf.util.BufferedByteStream()
+    encoder = pyamf.amf0.Encoder(stream)
+    for value in values:
+        encoder.writeElement(value)
+    return stream.getvalue()
+
+def pyamf_decode(data):
+    """ Decode all the values found in data with pyamf. """
+    decoder = pyamf.amf0.Decoder(pyamf.util.BufferedByteStream(data))
+    values = []
+    while not decoder.stream.at_eof():
+        values.append(decoder.readElement())
+    return values
+
+class Amf0Test(unittest.TestCase):
+
+    def check_round_trip(self, *values):
+        """
+        Check that rtmp_amf0 encodes values to the same bytes as pyamf and
+        decodes them (from a str and in place from a bytearray) to the same
+        values and types. Return the decoded values.
+        """
+        data = rtmp_amf0.encode(*values)
+        self.assertEqual(data, pyamf_encode(*values))
+        expected = pyamf_decode(data)
+        for buf in (data, bytearray(data)):
+            decoded = rtmp_amf0.decode(buf)
+            self.assertEqual(decoded, expected)
+            self.assertEqual(map(type, decoded), map(type, expected))
+        return decoded
+
+    def test_references(self):
+        obj = {u'a': 1}
+        items = [1, 2]
+        decoded = self.check_round_trip(obj, obj, [obj, items, items])
+        self.assertIs(decoded[0], decoded[1])
+        self.assertIs(decoded[0], decoded[2][0])
+        self.assertIs(decoded[2][1], decoded[2][2])
+
+    def test_mixed_array_int_keys(self):
+        array = pyamf.MixedArray({0: u'a', 1: u'b', 5: u'c', u'key': 2})
+        decoded, = self.check_round_trip(array)
+        self.assertEqual(sorted(decoded.keys()), [0, 1, 5, 'key'])
+
+    def test_long_strings(self):
+        # One byte under, at and over the limit of a short string, in ASCII
+        # and in characters that take two bytes in UTF-8.
+        strings = [u'x' * 0xfffe, u'x' * 0xffff, u'x' * 0x10000,
+            u'\xe9' * 0x8000, 'y' * 0x10000]
+        self.check_round_trip(*strings)
+        self.assertEqual(rtmp_amf0.encode(u'x' * 0xffff)[0],
+            rtmp_amf0.STRING)
+        self.assertEqual(rtmp_amf0.encode(u'x' * 0x10000)[0],
+            rtmp_amf0.LONG_STRING)
+
+    def test_numbers(self):
+        numbers = [3.0, 2.0 ** 53, -0.0, 1.5, 10 ** 20, float('inf')]
+        decoded = self.check_round_trip(*numbers)
+        # Integers stored as floats are decoded as ints.
+        self.assertEqual(map(type, decoded[:3]), [int, int, int])
+        # NaN is not equal to itself.
+        data = rtmp_amf0.encode(float('nan'))
+        self.assertEqual(data, pyamf_encode(float('nan')))
+        value, = rtmp_amf0.decode(data)
+        self.assertIs(type(value), float)
+        self.assertNotEqual(value, value)
+
+    def test_undefined(self):
+        decoded = self.check_round_trip(pyamf.Undefined, None, True, False,
+            [pyamf.Undefined])
+        self.assertIs(decoded[0], pyamf.Undefined)
+        self.assertIs(decoded[4][0], pyamf.Undefined)
+
+class RtmpReaderTest(unittest.TestCase):
+
+    def check_messages(self, messages):
+        self.assertEqual(len(messages), 2)
+        self.assertEqual([str(message.body) for message in messages],
+            ['a' * 10, 'b' * 10])
+        self.assertEqual([message.timestamp for message in messages],
+            [0x01000000, 0x02000000])
+        self.assertEqual([message.stream_id for message in messages], [1, 1])
+
+    def test_type3_header_after_extended_timestamp(self):
+        # A type 3 header that starts a new message carries the extended
+        # timestamp field of the chunk stream too.
+        data = FULL_EXTENDED_HEADER + 'a' * 10 + TYPE3_EXTENDED_HEADER + \
+            'b' * 10
+        reader = rtmp_protocol.RtmpReader(
+            rtmp_protocol.FileDataTypeMixIn(io.BytesIO(data)))
+        self.check_messages([reader.next(), reader.next()])
+
+    def test_type3_header_after_extended_timestamp_fed(self):
+        # The sans-IO engine has to wait for the extended timestamp field.
+        data = FULL_EXTENDED_HEADER + 'a' * 10 + TYPE3_EXTENDED_HEADER + \
+            'b' * 10
+        state = rtmp_protocol.RtmpConnectionState(is_client=False)
+        state.state = state.ESTABLISHED
+        messages = []
+        for byte in data:
+            messages.extend(state.feed(byte))
+        self.check_messages(messages)
+
+    def test_relay_undecoded_messages(self):
+        # Received commands and SO messages keep their timestamp and message
+        # stream, so that they are forwarded as they arrived.
+        data = encode_messages([
+            rtmp_protocol.CommandMessage([u'publish', 0, None, u'cam'],
+                timestamp=40, stream_id=1),
+            rtmp_protocol.SharedObjectMessage(u'so_name', 1, events=[
+                rtmp_protocol.SOEvent(rtmp_protocol.SOEventTypes.USE)],
+                timestamp=80, stream_id=2),
+        ])
+        messages = read_messages(data, 2)
+        self.assertEqual([(message.timestamp, message.stream_id)
+            for message in messages], [(40, 1), (80, 2)])
+        self.assertFalse(messages[0].decoded())
+        self.assertFalse(messages[1].decoded())
+        self.assertEqual(encode_messages(messages), data)
+
+class RtmpWriterTest(unittest.TestCase):
+
+    def test_header_compression(self):
+        # (timestamp, body length, message stream id, expected header type)
+        cases = [
+            (0, 10, 1, 0),
+            # The length changes.
+            (40, 20, 1, 1),
+            # Only the timestamp delta changes.
+            (60, 20, 1, 2),
+            # Nothing changes.
+            (80, 20, 1, 3),
+            (100, 20, 1, 3),
+            # A message longer than a chunk.
+            (120, 300, 1, 1),
+            # The timestamp decreases.
+            (50, 300, 1, 0),
+            # The message stream changes.
+            (90, 300, 2, 0),
+            # The delta does not fit in the timestamp field.
+            (90 + 0xffffff, 300, 2, 0),
+            (100 + 0xffffff, 300, 2, 2),
+            (100 + 2 * 0xffffff, 300, 2, 0),
+        ]
+        writer = rtmp_protocol.RtmpWriter(
+            rtmp_protocol.FileDataTypeMixIn(io.BytesIO()))
+        fileobject = writer.stream.fileobject
+        messages = []
+        for i, (timestamp, length, stream_id, header_type) in \
+                enumerate(cases):
+            message = rtmp_protocol.VideoMessage(chr(i) * length, timestamp,
+                stream_id)
+            start = fileobject.tell()
+            writer.write(message)
+            self.assertEqual(ord(fileobject.getvalue()[start]) >> 6,
+                header_type, cases[i])
+            messages.append(message)
+
+        received = read_messages(fileobject.getvalue(), len(messages))
+        self.assertEqual(
+            [(str(message.body), message.timestamp, message.stream_id)
+                for message in received],
+            [(message.body, message.timestamp, message.stream_id)
+                for message in messages])
+
+def feed_in_splits(state, data, rand):
+    """
+    Feed data to an RtmpConnectionState in pieces of random sizes and return
+    the messages it completed.
+    """
+    messages = []
+    pos = 0
+    while pos < len(data):
+        end = pos + rand.randint(1, 300)
+        messages.extend(state.feed(data[pos:end]))
+        pos = end
+    return messages
+
+class RtmpConnectionStateTest(unittest.TestCase):
+
+    def test_feed_random_splits(self):
+        rand = random.Random(1)
+        client = rtmp_protocol.RtmpConnectionState(is_client=True)
+        server = rtmp_protocol.RtmpConnectionState(is_client=False)
+        # C0 and C1, S0, S1 and S2, then C2.
+        self.assertEqual(feed_in_splits(server, client.data_to_send(), rand),
+            [])
+        self.assertEqual(feed_in_splits(client, server.data_to_send(), rand),
+            [])
+        self.assertEqual(feed_in_splits(server, client.data_to_send(), rand),
+            [])
+        self.assertEqual(server.state, server.ESTABLISHED)
+        self.assertEqual(client.state, client.ESTABLISHED)
+
+        messages = []
+        for i in xrange(50):
+            messages.append(rtmp_protocol.CommandMessage(
+                [u'call', i, None, u'x' * rand.randint(0, 500)]))
+            messages.append(rtmp_protocol.VideoMessage(
+                chr(i) * rand.randint(1, 1000), i * 40, 1))
+            for message in messages[-2:]:
+                client.send(message)
+            if i == 25:
+                # Applies to the chunks that follow in the same feed.
+                client.writer.set_chunk_size(256)
+                messages.append(rtmp_protocol.SetChunkSizeMessage(256))
+
+        received = feed_in_splits(server, client.data_to_send(), rand)
+        self.assertEqual(len(received), len(messages))
+        for message, expected in zip(received, messages):
+            self.assertEqual(message.datatype, expected.datatype)
+            if expected.datatype == rtmp_protocol.DataTypes.COMMAND:
+                self.assertEqual(message.command, expected.command)
+            elif expected.datatype == rtmp_protocol.DataTypes.VIDEO:
+                self.assertEqual(str(message.body), expected.body)
+                self.assertEqual(message.timestamp, expected.timestamp)
+            else:
+                self.assertEqual(message.chunk_size, 256)
+        self.assertEqual(server.reader.chunk_size, 256)
+
+if __name__ == '__main__':
+    unittest.main()
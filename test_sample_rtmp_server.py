@@ -0,0 +1,80 @@
+"""
+Tests for sample_rtmp_server.
+"""
+
+import asyncore
+import socket
+import threading
+import time
+import unittest
+
+import sample_rtmp_server
+
+class SharedObjectSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        # Two workers connected by a Unix socket, like serve_prefork does.
+        sockets = socket.socketpair()
+        self.servers = []
+        self.syncs = []
+        for worker_id in xrange(2):
+            server = sample_rtmp_server.RTMPServer(('127.0.0.1', 0))
+            self.servers.append(server)
+            self.syncs.append(sample_rtmp_server.SharedObjectSync(server,
+                worker_id, [sockets[worker_id]]))
+
+    def tearDown(self):
+        for server in self.servers:
+            for dispatcher in server.socket_map.values():
+                dispatcher.close()
+
+    def replicate(self, source, target):
+        """ Deliver the sync messages queued by one worker to the other. """
+        self.syncs[source].links[0].handle_write()
+        self.syncs[target].links[0].handle_read()
+
+    def data(self, worker_id, name):
+        return self.servers[worker_id].shared_objects.get(name).data
+
+    def test_non_ascii_key(self):
+        key = u'caf\xe9'
+        self.servers[0].shared_objects.update(u'so', {key: 1})
+        self.replicate(0, 1)
+        self.assertEqual(self.data(1, u'so'), {key: 1})
+        self.assertEqual([type(k) for k in self.data(1, u'so')], [unicode])
+
+        # A later change from the other worker wins over the first one.
+        self.servers[1].shared_objects.update(u'so', {key: 2})
+        self.replicate(1, 0)
+        self.assertEqual(self.data(0, u'so'), {key: 2})
+
+        self.servers[0].shared_objects.update(u'so', {}, [key])
+        self.replicate(0, 1)
+        self.assertEqual(self.data(0, u'so'), {})
+        self.assertEqual(self.data(1, u'so'), {})
+
+class ShutdownTest(unittest.TestCase):
+
+    def test_client_not_reading(self):
+        # A client that stops reading cannot keep the server running after
+        # the shutdown timeout.
+        server = sample_rtmp_server.RTMPServer(('127.0.0.1', 0))
+        client = socket.create_connection(server.socket.getsockname())
+        self.addCleanup(client.close)
+        while not server.connections():
+            asyncore.loop(0.01, True, server.socket_map, 1)
+        conn, = server.connections()
+        conn.out_buffer += 'x' * 64 * 1024 * 1024
+
+        server.shutdown(timeout=0.2)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        start = time.time()
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(server.socket_map, {})
+
+if __name__ == '__main__':
+    unittest.main()